@@ -0,0 +1,334 @@
+"""Offline benchmarks for SPSSINC ANON
+
+Runs the extension command against the in-memory stand-in for the spss module in
+fakespss.py and reports rows per second and peak traced memory for each scenario.
+No Statistics installation is needed.
+
+    python benchmarks/bench_anon.py                  # all scenarios, 200000 rows
+    python benchmarks/bench_anon.py --rows 1000000 methods onetoone
+    python benchmarks/bench_anon.py --list
+
+Timings are taken without memory tracing.  Each scenario is then run again with
+tracemalloc to get the peak memory, unless --nomemory is given.
+"""
+
+import sys, os, io, time, random, tempfile, tracemalloc, argparse, contextlib
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [here, os.path.join(os.path.dirname(here), "src")]
+
+import fakespss
+fakespss.install()
+import SPSSINC_ANON as anon
+
+def numericcolumn(rows, cardinality, seed=1, missing=0.01):
+    """Return rows values drawn from cardinality distinct numbers, with some sysmis"""
+    
+    r = random.Random(seed)
+    return [None if r.random() < missing else float(r.randrange(cardinality) * 7 + 1000)
+        for i in range(rows)]
+
+def stringcolumn(rows, cardinality, seed=2, width=20):
+    r = random.Random(seed)
+    return [("ID%09d" % r.randrange(cardinality)).ljust(width) for i in range(rows)]
+
+class FakeVariable(object):
+    """Enough of a Statistics variable to construct a Tvar directly"""
+    
+    def __init__(self, name, vtype):
+        self.name = name
+        self.type = vtype
+
+def dataset(rows, specs):
+    """Make the active dataset from specs, a list of (name, type, cardinality)"""
+    
+    variables, columns = [], []
+    for i, (name, vtype, cardinality) in enumerate(specs):
+        variables.append((name, vtype))
+        if vtype == 0:
+            columns.append(numericcolumn(rows, cardinality, seed=i))
+        else:
+            columns.append(stringcolumn(rows, cardinality, seed=i, width=vtype))
+    return fakespss.newdataset(variables, columns)
+
+def cellbycell(varnames, method="sequential", seed=None, maxrvalue=None, onetoone=None,
+        svalueroot="", offset=None, scale=None):
+    """The pre-block engine: one read and one write per cell, for comparison"""
+    
+    with anon.DataStep():
+        ds = anon.spss.Dataset()
+        allvariables = ds.varlist
+        varnums = [allvariables[v].index for v in varnames]
+        maxrvalue = maxrvalue or [9999999]
+        if len(maxrvalue) == 1:
+            maxrvalue = len(varnums) * maxrvalue
+        onetoone = set(onetoone or [])
+        todo = [(vn, anon.Tvar(allvariables[vn], svalueroot, method, offset, scale,
+            maxrvalue[i], allvariables[vn].name in onetoone, seed=seed))
+            for i, vn in enumerate(varnums)]
+        for i, case in enumerate(ds.cases):
+            for vnum, t in todo:
+                ds.cases[i, vnum] = t.trf(case[vnum])
+
+# Each scenario is (name, group, setup, run).  setup(rows) prepares the inputs and
+# returns an argument for run, which does the timed work and returns the number
+# of rows processed.
+
+def anonscenario(name, group, specs, **kwds):
+    def setup(rows):
+        dataset(rows, specs)
+        return rows
+    def run(rows):
+        anon.anon([spec[0] for spec in specs], **kwds)
+        return rows
+    return (name, group, setup, run)
+
+def cellscenario(name, group, specs, **kwds):
+    def setup(rows):
+        dataset(rows, specs)
+        return rows
+    def run(rows):
+        cellbycell([spec[0] for spec in specs], **kwds)
+        return rows
+    return (name, group, setup, run)
+
+def onetoonescenario(name, fill, vtype=0):
+    """Map rows distinct values one to one into a range that they fill to the given ratio"""
+    
+    def setup(rows):
+        t = anon.Tvar(FakeVariable("id", vtype), vtype and "ID" or "", "random", None, None, 
+            int(rows / fill) - 1, True, seed=1)
+        t.chooseallocator(rows)   # as the capacity check in anon does
+        if vtype:
+            return t, ["K%09d" % i for i in range(rows)]
+        return t, [float(i) for i in range(rows)]
+    def run(args):
+        t, values = args
+        for start in range(0, len(values), 10000):
+            t.trfblock(values[start:start+10000])
+        return len(values)
+    return (name, "onetoone", setup, run)
+
+def mappingscenario(name, vtype, action, binary):
+    """Write or load the value mapping of a fully distinct variable"""
+    
+    def setup(rows):
+        t = anon.Tvar(FakeVariable("id", vtype), "", "sequential", None, None, 9999999, False)
+        if vtype == 0:
+            values = [float(i) for i in range(rows)]
+        else:
+            values = ["ID%09d" % i for i in range(rows)]
+        t.trfblock(values)
+        fd, filespec = tempfile.mkstemp(prefix="anonbench")
+        os.close(fd)
+        if action == "load":
+            writemapping(t, filespec, binary)
+        return t, filespec
+    def run(args):
+        t, filespec = args
+        try:
+            if action == "save":
+                writemapping(t, filespec, binary)
+            else:
+                newt = anon.Tvar(FakeVariable("id", vtype), "", "sequential", None, None, 
+                    9999999, False)
+                anon.mapinputs([newt], filespec)
+        finally:
+            os.remove(filespec)
+        return len(t.table)
+    return (name, "mapping", setup, run)
+
+def batchscenario(name, nfiles, batch):
+    """Anonymize nfiles files that share an id variable, either with BATCH or with one
+    run per file that reads the previous run's VALUEMAPPING as MAPPING"""
+    
+    def setup(rows):
+        dataset(1, [("x", 0, 1)])
+        tempdir = tempfile.mkdtemp(prefix="anonbench")
+        files = []
+        for i in range(nfiles):
+            filespec = os.path.join(tempdir, "in%s.sav" % i)
+            fakespss.newfile(filespec, [("id", 0), ("s", 20)], 
+                [numericcolumn(rows // nfiles, rows, seed=i), 
+                stringcolumn(rows // nfiles, 1000, seed=i)])
+            files.append(filespec)
+        return tempdir, files
+    def run(args):
+        tempdir, files = args
+        outdir = os.path.join(tempdir, "out")
+        mapping = os.path.join(tempdir, "values.csv")
+        try:
+            if batch:
+                anon.anonbatch(["id", "s"], files=files, outdir=outdir, method="random", seed=1,
+                    valuemapping=mapping)
+            else:
+                for i, filespec in enumerate(files):
+                    fakespss.Submit('GET FILE="%s".' % filespec)
+                    anon.anon(["id", "s"], method="random", seed=1, valuemapping=mapping + str(i),
+                        mapping=i and mapping + str(i - 1) or None)
+                    fakespss.Submit('SAVE OUTFILE="%s".' % os.path.join(outdir, 
+                        os.path.basename(filespec)))
+        finally:
+            for f in os.listdir(tempdir):
+                os.remove(os.path.join(tempdir, f))
+            os.rmdir(tempdir)
+        return len(files) * len(fakespss.filecolumn(files[0], "id"))
+    return (name, "batch", setup, run)
+
+def historyscenario(name, backend, history=10):
+    """Anonymize a dataset whose values are mostly among the first rows values of a
+    mapping history of history times as many values, read from a binary MAPPING file
+    or kept in a MAPPINGDB"""
+    
+    def setup(rows):
+        t = anon.Tvar(FakeVariable("id", 0), "", "random", None, None, 999999999, False, seed=1)
+        t.trfblock([float(i) for i in range(rows * history)])
+        fd, filespec = tempfile.mkstemp(prefix="anonbench")
+        os.close(fd)
+        os.remove(filespec)
+        if backend == "binary":
+            anon.writebinarymapping([t], filespec)
+        else:
+            db = anon.MappingDatabase(filespec)
+            t.table, table = anon.DatabaseTable(db, "id", 0), t.table
+            t.table.update(table.items())
+            t.store()
+            db.close()
+        r = random.Random(3)
+        fakespss.newdataset([("id", 0)], [[float(r.random() < 0.99 and r.randrange(rows) or
+            rows * history + i) for i in range(rows)]])
+        return rows, filespec
+    def run(args):
+        rows, filespec = args
+        try:
+            if backend == "binary":
+                anon.anon(["id"], method="random", seed=1, maxrvalue=[999999999], mapping=filespec)
+            else:
+                anon.anon(["id"], method="random", seed=1, maxrvalue=[999999999], 
+                    mappingdb=filespec)
+        finally:
+            for suffix in ["", "-wal", "-shm"]:
+                if os.path.exists(filespec + suffix):
+                    os.remove(filespec + suffix)
+        return rows
+    return (name, "mapping", setup, run)
+
+def widescenario(name, nvars, nanon):
+    """Anonymize and rename nanon of nvars variables of a dataset with few cases"""
+    
+    def setup(rows):
+        fakespss.newdataset([("x%s" % i, 0) for i in range(nvars)], [[1.0]] * nvars)
+        return ["x%s" % i for i in range(0, nvars, nvars // nanon)]
+    def run(varnames):
+        anon.anon(varnames, nameroot="x")
+        return len(varnames)
+    return (name, "dictionary", setup, run)
+
+def writemapping(t, filespec, binary):
+    if binary:
+        anon.writebinarymapping([t], filespec)
+    else:
+        with open(filespec, "w", newline="", encoding="utf-8") as f:
+            t.write(anon.csv.writer(f))
+
+def scenarios():
+    result = [
+        anonscenario("sequential numeric", "methods", [("n", 0, 1000)]),
+        anonscenario("sequential string", "methods", [("s", 20, 1000)]),
+        anonscenario("sequential string card=1000000", "methods", [("s", 20, 1000000)],
+            svalueroot="ID"),
+        anonscenario("random numeric", "methods", [("n", 0, 1000)], method="random", seed=1),
+        anonscenario("random string", "methods", [("s", 20, 1000)], method="random", seed=1),
+        anonscenario("transform numeric", "methods", [("n", 0, 1000)], method="transform",
+            offset=3, scale=2),
+        anonscenario("random 4 vars", "methods", [("a", 0, 1000), ("b", 0, 50), ("c", 20, 5000),
+            ("d", 0, 100000)], method="random", seed=1),
+        anonscenario("random 4 vars workers=2", "methods", [("a", 0, 1000), ("b", 0, 50), 
+            ("c", 20, 5000), ("d", 0, 100000)], method="random", seed=1, workers=2),
+        anonscenario("hash 4 vars", "workers", [(name, 0, 1000000)
+            for name in "abcd"], method="hash", key="bench", maxrvalue=[99999999]),
+        anonscenario("hash 4 vars workers=4", "workers", [(name, 0, 1000000)
+            for name in "abcd"], method="hash", key="bench", maxrvalue=[99999999], workers=4),
+        anonscenario("onetoone 4 vars", "workers", [(name, 0, 1000000)
+            for name in "abcd"], method="random", seed=1, onetoone=list("abcd"), 
+            maxrvalue=[99999999]),
+        anonscenario("onetoone 4 vars workers=4", "workers", [(name, 0, 1000000)
+            for name in "abcd"], method="random", seed=1, onetoone=list("abcd"), 
+            maxrvalue=[99999999], workers=4),
+        anonscenario("random 4 vars checkpoint", "methods", [("a", 0, 1000), ("b", 0, 50), 
+            ("c", 20, 5000), ("d", 0, 100000)], method="random", seed=1, 
+            checkpoint=os.path.join(tempfile.gettempdir(), "anonbench.checkpoint")),
+        cellscenario("cell by cell sequential", "baseline", [("n", 0, 1000)]),
+        cellscenario("cell by cell random 4 vars", "baseline", [("a", 0, 1000), ("b", 0, 50),
+            ("c", 20, 5000), ("d", 0, 100000)], method="random", seed=1),
+        cellscenario("cell by cell transform", "baseline", [("n", 0, 1000)], method="transform",
+            offset=3, scale=2),
+    ]
+    for cardinality in [10, 1000, 100000, 10000000]:
+        result.append(anonscenario("sequential numeric card=%s" % cardinality, "cardinality",
+            [("n", 0, cardinality)]))
+        result.append(anonscenario("random string card=%s" % cardinality, "cardinality",
+            [("s", 20, cardinality)], method="random", seed=1))
+    for fill in [0.1, 0.5, 0.9, 1.0]:
+        result.append(onetoonescenario("onetoone fill=%s" % fill, fill))
+    result.append(onetoonescenario("onetoone string fill=0.5", 0.5, vtype=20))
+    result.append(anonscenario("onetoone dataset", "onetoone", [("n", 0, 10000000)], 
+        method="random", seed=1, onetoone=["n"], maxrvalue=[99999999]))
+    for vtype in [0, 20]:
+        kind = vtype and "string" or "numeric"
+        for binary in [False, True]:
+            fmt = binary and "binary" or "csv"
+            result.append(mappingscenario("save %s %s" % (fmt, kind), vtype, "save", binary))
+            result.append(mappingscenario("load %s %s" % (fmt, kind), vtype, "load", binary))
+    result.append(historyscenario("history x10 binary MAPPING", "binary"))
+    result.append(historyscenario("history x10 MAPPINGDB", "db"))
+    result.append(widescenario("rename 3000 of 30000 vars", 30000, 3000))
+    result.append(batchscenario("8 files one run each", 8, False))
+    result.append(batchscenario("8 files batch", 8, True))
+    return result
+
+def measure(scenario, rows, memory):
+    """Return the rows processed, seconds, and peak bytes or None for a scenario
+    
+    The command's own messages are not shown"""
+    
+    name, group, setup, run = scenario
+    with contextlib.redirect_stdout(io.StringIO()):
+        arg = setup(rows)
+        start = time.perf_counter()
+        count = run(arg)
+        elapsed = time.perf_counter() - start
+        peak = None
+        if memory:
+            arg = setup(rows)
+            tracemalloc.start()
+            run(arg)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return count, elapsed, peak
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SPSSINC ANON offline benchmarks")
+    parser.add_argument("selection", nargs="*", 
+        help="scenario groups or name fragments to run (default all)")
+    parser.add_argument("--rows", type=int, default=200000, help="rows per scenario")
+    parser.add_argument("--nomemory", action="store_true", help="skip peak memory measurement")
+    parser.add_argument("--list", action="store_true", help="list the scenarios and exit")
+    args = parser.parse_args(argv)
+    
+    selected = [s for s in scenarios() if not args.selection or 
+        any(sel == s[1] or sel in s[0] for sel in args.selection)]
+    if args.list:
+        for name, group, setup, run in selected:
+            print("%-12s %s" % (group, name))
+        return
+    print("%-12s %-34s %10s %9s %12s %9s" % ("group", "scenario", "rows", "seconds", 
+        "rows/sec", "peak MB"))
+    for scenario in selected:
+        count, elapsed, peak = measure(scenario, args.rows, not args.nomemory)
+        print("%-12s %-34s %10d %9.3f %12.0f %9s" % (scenario[1], scenario[0], count, elapsed,
+            count / max(elapsed, 1e-9), peak is None and "-" or "%.1f" % (peak / 1024. / 1024)))
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
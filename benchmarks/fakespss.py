@@ -0,0 +1,385 @@
+"""In-memory stand-in for the parts of the spss module used by SPSSINC ANON
+
+This lets the extension command run, be timed, and be checked without an IBM SPSS
+Statistics installation.  It covers the active dataset only: Dataset.varlist,
+Dataset.cases with the index and slice forms used by the command, variable
+valueLabels and missingValues, StartDataStep, EndDataStep, and Submit, and
+StartProcedure, BasePivotTable.SimplePivotTable, and EndProcedure, which record
+the tables in state["tables"].  Submit carries out the VALUE LABELS and MISSING
+VALUES commands that clear labels and missing values and RENAME VARIABLES.  Named datasets and sav files are simulated with
+the GET FILE, SAVE OUTFILE, and DATASET NAME, ACTIVATE, and CLOSE commands, which
+work on in-memory copies in state["datasets"] and state["files"].
+
+Usage:
+    import fakespss
+    fakespss.install()      # registers spss, spssaux, and extension in sys.modules
+    fakespss.newdataset([("id", 0), ("name", 20)], [idcolumn, namecolumn])
+    import SPSSINC_ANON
+    SPSSINC_ANON.anon(["id", "name"], method="random")
+    fakespss.column("id")   # the anonymized values
+"""
+
+import sys, re, types
+
+class SpssError(Exception):
+    """Error raised by the fake for misuse that Statistics would reject"""
+    pass
+
+class Variable(object):
+    """A variable of the active dataset.  type is 0 for numeric or the string width"""
+    
+    def __init__(self, data, index, name, vtype):
+        self.data = data
+        self.index = index
+        self._name = name
+        self.type = vtype
+        self.valueLabels = {}
+        self.missingValues = (0, None, None, None)
+        
+    def _getname(self):
+        return self._name
+    
+    def _setname(self, name):
+        self.data.checkstep()
+        self.rename(name)
+        
+    def rename(self, name):
+        if name.lower() in self.data.names and self.data.names[name.lower()] is not self:
+            raise SpssError("Duplicate variable name: %s" % name)
+        del self.data.names[self._name.lower()]
+        self._name = name
+        self.data.names[name.lower()] = self
+        self.data.stats["renames"] += 1
+        
+    name = property(_getname, _setname)
+
+class VariableList(object):
+    """Dataset.varlist: variables by name (case insensitive) or index"""
+    
+    def __init__(self, data):
+        self.data = data
+        
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self.data.variables[key]
+        try:
+            return self.data.names[key.lower()]
+        except KeyError:
+            raise SpssError("Variable not found: %s" % key)
+        
+    def __iter__(self):
+        return iter(self.data.variables)
+    
+    def __len__(self):
+        return len(self.data.variables)
+
+class CaseList(object):
+    """Dataset.cases: values are stored by column
+    
+    cases[i] and iteration give a tuple of all the values of a case,
+    cases[i:j] a list of such tuples, cases[i, k] a 1-tuple, and cases[i:j, k]
+    a list of 1-tuples.  Assignment accepts cases[i, k] = value and
+    cases[i:j, k] = sequence of values.  Reads and writes are counted in the
+    stats of the dataset."""
+    
+    def __init__(self, data):
+        self.data = data
+        
+    def __len__(self):
+        return self.data.numcases
+    
+    def __iter__(self):
+        for i in range(self.data.numcases):
+            yield self[i]
+        
+    def __getitem__(self, key):
+        data = self.data
+        data.checkstep()
+        data.stats["reads"] += 1
+        if isinstance(key, tuple):
+            rows, k = key
+            column = data.columns[k]
+            if isinstance(rows, slice):
+                values = column[rows]
+                data.stats["valuesread"] += len(values)
+                return [(value,) for value in values]
+            data.stats["valuesread"] += 1
+            return (column[rows],)
+        if isinstance(key, slice):
+            rows = list(zip(*[column[key] for column in data.columns]))
+            data.stats["valuesread"] += len(rows) * len(data.columns)
+            return rows
+        data.stats["valuesread"] += len(data.columns)
+        return tuple(column[key] for column in data.columns)
+    
+    def __setitem__(self, key, value):
+        data = self.data
+        data.checkstep()
+        data.stats["writes"] += 1
+        rows, k = key
+        column = data.columns[k]
+        vtype = data.variables[k].type
+        if isinstance(rows, slice):
+            value = list(value)
+            if len(value) != len(column[rows]):
+                raise SpssError("Wrong number of values for case range")
+            for v in value:
+                data.checkvalue(v, vtype)
+            column[rows] = value
+            data.stats["valueswritten"] += len(value)
+        else:
+            data.checkvalue(value, vtype)
+            column[rows] = value
+            data.stats["valueswritten"] += 1
+
+class ActiveData(object):
+    """The variables and columns of the active dataset"""
+    
+    def __init__(self, variables, columns):
+        self.name = "*"
+        self.variables = []
+        self.names = {}
+        for i, (name, vtype) in enumerate(variables):
+            v = Variable(self, i, name, vtype)
+            self.variables.append(v)
+            self.names[name.lower()] = v
+        self.columns = [list(column) for column in columns]
+        lengths = set(len(column) for column in self.columns)
+        if len(lengths) > 1:
+            raise ValueError("All columns must have the same number of cases")
+        self.numcases = lengths and lengths.pop() or 0
+        self.stats = dict.fromkeys(["reads", "writes", "valuesread", "valueswritten",
+            "renames", "executes", "datasteps", "dictionarycommands"], 0)
+        
+    def checkstep(self):
+        if not state["datastep"]:
+            raise SpssError("Dataset objects can only be used within a data step")
+        
+    def checkvalue(self, value, vtype):
+        if vtype == 0:
+            if value is not None and not isinstance(value, (int, float)):
+                raise SpssError("Invalid numeric value: %r" % (value,))
+        elif not isinstance(value, str) or len(value.encode("utf-8")) > vtype:
+            raise SpssError("Invalid value for string of width %s: %r" % (vtype, value))
+
+    def copy(self):
+        return ActiveData([(v.name, v.type) for v in self.variables], self.columns)
+
+state = {"data": None, "datastep": False, "pending": False, "submitted": [],
+    "procedure": None, "tables": [], "datasets": {}, "files": {}}
+
+class Dataset(object):
+    """The active dataset.  Only name=None (the active dataset) is supported"""
+    
+    def __init__(self, name=None, hidden=False, cvtDates=False):
+        data = state["data"]
+        if data is None:
+            raise SpssError("There is no active dataset")
+        data.checkstep()
+        self.varlist = VariableList(data)
+        self.cases = CaseList(data)
+        self.name = name or "*"
+        
+    def close(self):
+        pass
+
+def StartDataStep():
+    if state["pending"]:
+        raise SpssError("There are pending transformations")
+    if state["datastep"]:
+        raise SpssError("A data step is already in progress")
+    state["datastep"] = True
+    if state["data"] is not None:
+        state["data"].stats["datasteps"] += 1
+    
+def EndDataStep():
+    state["datastep"] = False
+    
+def IsDataStepInProgress():
+    return state["datastep"]
+
+def ActiveDataset():
+    data = state["data"]
+    return data is None and "*" or data.name
+
+def Submit(cmds):
+    """Record submitted syntax.  EXECUTE runs pending transformations, and the
+    dataset and file commands listed above are carried out"""
+    
+    if state["datastep"]:
+        raise SpssError("Submit cannot be used while a data step is in progress")
+    if isinstance(cmds, str):
+        cmds = [cmds]
+    for cmd in commands(cmds):
+        state["submitted"].append(cmd)
+        if cmd.upper().startswith("EXECUTE"):
+            state["pending"] = False
+            if state["data"] is not None:
+                state["data"].stats["executes"] += 1
+        elif not dictionarycommand(cmd):
+            datasetcommand(cmd)
+
+def commands(lines):
+    """Join submitted lines into commands.  A command ends with a line ending in a
+    period or at the end of the lines"""
+    
+    result, command = [], []
+    for line in lines:
+        command.append(line.strip())
+        if line.rstrip().endswith("."):
+            result.append(" ".join(command))
+            command = []
+    if command:
+        result.append(" ".join(command))
+    return result
+
+def dictionarycommand(cmd):
+    """Carry out VALUE LABELS or MISSING VALUES with no values, which clear them, or
+    RENAME VARIABLES (old names = new names).  Return False for other commands"""
+    
+    data = state["data"]
+    m = re.match(r"(VALUE\s+LABELS|MISSING\s+VALUES)\s+([^()]*?)\s*(\(\s*\))?\s*\.?$", cmd, 
+        re.IGNORECASE)
+    if m:
+        if m.group(1).upper().startswith("VALUE") == bool(m.group(3)):
+            raise SpssError("Only clearing value labels or missing values is supported: %s" % cmd)
+        for v in [data.names[name.lower()] for name in m.group(2).split()]:
+            if m.group(3):
+                v.missingValues = (0, None, None, None)
+            else:
+                v.valueLabels = {}
+        data.stats["dictionarycommands"] += 1
+        return True
+    m = re.match(r"RENAME\s+VARIABLES\s*\(([^=]*)=([^)]*)\)\s*\.?$", cmd, re.IGNORECASE)
+    if m:
+        old, new = m.group(1).split(), m.group(2).split()
+        if len(old) != len(new):
+            raise SpssError("RENAME VARIABLES has different numbers of old and new names")
+        if len(set(name.lower() for name in new)) != len(new):
+            raise SpssError("RENAME VARIABLES has duplicate new names")
+        variables = [data.names[name.lower()] for name in old]
+        # the variables are renamed together, so a new name can be an old one
+        for v in variables:
+            del data.names[v.name.lower()]
+        for v, name in zip(variables, new):
+            v._name = "#" + name
+            data.names[v._name.lower()] = v
+        for v, name in zip(variables, new):
+            v.rename(name)
+        data.stats["dictionarycommands"] += 1
+        return True
+    return False
+
+def datasetcommand(cmd):
+    """Carry out GET FILE, SAVE OUTFILE, or DATASET NAME, ACTIVATE, or CLOSE"""
+    
+    datasets = state["datasets"]
+    m = re.match(r'(GET FILE|SAVE OUTFILE)\s*=\s*"((?:[^"]|"")*)"', cmd, re.IGNORECASE)
+    if m:
+        filespec = m.group(2).replace('""', '"')
+        if m.group(1).upper() == "SAVE OUTFILE":
+            state["files"][filespec] = state["data"].copy()
+            return
+        if not filespec in state["files"]:
+            raise SpssError("File not found: %s" % filespec)
+        state["data"] = state["files"][filespec].copy()
+        state["pending"] = False
+        return
+    m = re.match(r"DATASET\s+(NAME|ACTIVATE|CLOSE)\s+(\w+)", cmd, re.IGNORECASE)
+    if not m:
+        return
+    action, name = m.group(1).upper(), m.group(2).lower()
+    data = state["data"]
+    if action == "NAME":
+        datasets.pop(data.name, None)
+        data.name = name
+        datasets[name] = data
+    elif action == "ACTIVATE":
+        if not name in datasets:
+            raise SpssError("Dataset not found: %s" % name)
+        state["data"] = datasets[name]
+    else:
+        if datasets.pop(name, None) is None:
+            raise SpssError("Dataset not found: %s" % name)
+        if data is not None and data.name == name:
+            data.name = "*"
+
+def StartProcedure(procname, omsid=None):
+    if state["datastep"]:
+        raise SpssError("StartProcedure cannot be used while a data step is in progress")
+    if state["procedure"] is not None:
+        raise SpssError("A procedure is already in progress")
+    state["procedure"] = procname
+    
+def EndProcedure():
+    if state["procedure"] is None:
+        raise SpssError("There is no procedure in progress")
+    state["procedure"] = None
+    
+class BasePivotTable(object):
+    """A pivot table.  Only SimplePivotTable is supported"""
+    
+    def __init__(self, title, templateName, outline="", caption=None, isSplit=True):
+        if state["procedure"] is None:
+            raise SpssError("Pivot tables can only be made within a procedure")
+        self.title = title
+        self.caption = caption
+        
+    def SimplePivotTable(self, rowdim="", rowlabels=[], coldim="", collabels=[], cells=None):
+        if cells is None or len(cells) != len(rowlabels) * len(collabels):
+            raise SpssError("The number of cells does not match the labels")
+        ncols = len(collabels)
+        state["tables"].append({"title": self.title, "caption": self.caption,
+            "rowlabels": list(rowlabels), "collabels": list(collabels),
+            "rows": [list(cells[i:i + ncols]) for i in range(0, len(cells), ncols)]})
+
+def newdataset(variables, columns, pending=False):
+    """Make a new active dataset and return it
+    
+    variables is a list of (name, type) pairs, columns a list of value lists.
+    If pending, the dataset has pending transformations, so StartDataStep fails
+    until EXECUTE is submitted"""
+    
+    state["data"] = ActiveData(variables, columns)
+    state["datastep"] = False
+    state["pending"] = pending
+    state["submitted"] = []
+    state["procedure"] = None
+    state["tables"] = []
+    state["datasets"] = {}
+    state["files"] = {}
+    return state["data"]
+
+def newfile(filespec, variables, columns):
+    """Make a sav file for GET FILE from variables and columns as for newdataset"""
+    
+    state["files"][filespec] = ActiveData(variables, columns)
+
+def filecolumn(filespec, name):
+    """Return the values of variable name in a saved file"""
+    
+    data = state["files"][filespec]
+    return data.columns[data.names[name.lower()].index]
+
+def column(name):
+    """Return the values of variable name in the active dataset"""
+    
+    data = state["data"]
+    return data.columns[data.names[name.lower()].index]
+
+def install():
+    """Register this module as spss, with minimal spssaux and extension modules,
+    so that SPSSINC_ANON can be imported"""
+    
+    sys.modules["spss"] = sys.modules[__name__]
+    spssaux = types.ModuleType("spssaux")
+    spssaux.VariableDict = lambda *args, **kwds: None
+    sys.modules.setdefault("spssaux", spssaux)
+    extension = types.ModuleType("extension")
+    class Template(object):
+        def __init__(self, *args, **kwds):
+            pass
+    extension.Template = Template
+    extension.Syntax = lambda *args, **kwds: None
+    extension.processcmd = lambda *args, **kwds: None
+    sys.modules.setdefault("extension", extension)
@@ -19,12 +19,18 @@ SPSSINC ANON.  Anonymize a set of variables.
 
 SPSSINC ANON  VARIABLES=varnames
 [/OPTIONS [SVALUEROOT='prefix'] [NAMEROOT=nprefix] 
-[METHOD={SEQUENTIAL*|TRANSFORM|RANDOM}]
-[SEED=number] [OFFSET=number] [SCALE=number]]
+[METHOD={SEQUENTIAL*|TRANSFORM|RANDOM|HASH}]
+[KEY="secret"] [SEED=number] [OFFSET=number] [SCALE=number]]
 [MAXRVALUE=positive integer or list of integers]
 [ONETOONE = varnames]
 [MAPPING= input filespec]
-[/SAVE [NAMEMAPPING=filespec] [VALUEMAPPING=filespec]]
+[BLOCKSIZE=number of cases] [MEMORYLIMIT=megabytes]
+[WORKERS=number of processes]
+[INCREMENTAL=state filespec] [PROFILE=NO*|YES]
+[CHECKPOINT=filespec [RESUME=NO*|YES]] [MAPPINGDB=filespec]
+[/SAVE [NAMEMAPPING=filespec] [VALUEMAPPING=filespec] [BINARYMAPPING=filespec]]
+[/BATCH {FILES="filespec" "filespec" ... OUTDIR="directory" [STREAM=NO*|YES] | 
+    DATASETS=names}]
 [/HELP]
 
 Example:
@@ -33,7 +39,7 @@ SPSSINC ANON x y z
 /SAVE VALUEMAPPING="c:/temp/values.txt".
 
 This command replaces the values of the specified variables with new values
-according to one of three methods.  It is intended for situations where the
+according to one of four methods.  It is intended for situations where the
 true values must be concealed for privacy or other reasons.  It can also
 replace the variables names with anonymous equivalents.
 
@@ -47,23 +53,45 @@ TRANSFORM, which applies only to numeric variables, calculates a new value
 according to the formula OFFSET + SCALE * value.  If TRANSFORM is
 specified and the variable list includes strings, SEQUENTIAL will be used
 for those variables.
+HASH replaces each value with a keyed hash (HMAC-SHA256) of the value reduced to
+the range [0, MAXRVALUE].  The same value always gets the same new value for the
+same KEY, in any dataset or run, so no mapping table is kept or needed.
 System-missing values are treated as the same value across cases, and for
 TRANSFORM, the new value will also be system missing.
 
-MAXRVALUES, which applies only to the RANDOM method, can be a single integer
+MAXRVALUES, which applies only to the RANDOM and HASH methods, can be a single integer
 applied to all variables or a list of as many integers as there are variables being
 anonymized.  For string variables, the range is further limited by the declared
 string width.
 
 TRANSFORM and SEQUENTIAL will produce unique values as long as, in the case
-of SEQUENTIAL with string variables, the field is wide enough.  For RANDOM,
+of SEQUENTIAL with string variables, the field is wide enough.  A warning is
+displayed when it is not.  For RANDOM,
 you can specify a list of one or more variables as ONETOONE, which will
 generate unique values if that is possible.  If unique values cannot be generated, the
-procedure will stop with an error message.  Using ONETOONE increases the time and
-memory requirements.
+procedure will stop with an error message.  Using ONETOONE increases the
+memory requirements.  For HASH, ONETOONE checks that no two values in the run
+hash to the same new value and stops with an error message if they do.
+
+Before any case is changed, a sample of the cases is read to estimate the number of
+new values of each RANDOM ONETOONE variable, unless its range can hold a new value for
+every case.  If the range cannot hold the new values
+found in the sample, the procedure stops with an error message, and if it might not hold
+the estimated number for all the cases, a warning is displayed.
+A warning is also displayed if SEQUENTIAL string values will probably not fit.  The
+estimate also decides how unique values of string variables are drawn: if less than
+half the range is expected to be used, values are drawn at random and drawn again if
+already in use, which is faster; otherwise they come from a random permutation of the
+range.  Numeric variables always use the permutation, which needs less memory.
+
+KEY is the secret for the HASH method and must be specified for it.  SEED is not
+used as the key, since it is a small number that usually appears in saved syntax.
+Anyone who knows the key can check whether a given value maps to a given hash,
+so it should be kept private.  HASH writes nothing to the value mapping files.
 
 For repeatability, you can specify a numerical value for SEED that will produce the
-same results if the syntax is rerun at a later time with the same inputs.
+same results if the syntax is rerun at a later time with the same inputs.  Each
+variable has its own random number stream derived from SEED and the variable name.
 
 If the variable is a string, SVALUEROOT can specify a string to be prefixed
 to the new integer values if the string is wide enough.
@@ -78,24 +106,140 @@ The new values are listed alphabetically by the new
 value within variable for ease of lookup.  As explained above, the inverse mapping 
 is sometimes not unique.
 
+BINARYMAPPING writes the same value mappings in a compact binary form that is
+much faster to load than the csv file but cannot be read as text.
+
 A new-values file can be used as input in a later run by specifying it in
 MAPPING if the method is SEQUENTIAL or RANDOM.  If given, any variable mappings defined in 
 that file are applied to the input values before applying the chosen method.
+MAPPING can also be a file written by BINARYMAPPING.
 This means that previously encountered values are mapped the same way
 as they were previously.  However, if MAXRVALUE is different or the string
 width is different, the results are undefined.
 
+Cases are read, transformed, and written back in blocks of BLOCKSIZE cases
+(default 10000).  Larger blocks mean fewer trips to the data but more memory.
+
+Mapping tables for numeric variables are kept in a compact form once they grow
+large.  If MEMORYLIMIT is specified, compacted tables beyond that many megabytes
+in total are moved to temporary files and read from there.
+
+WORKERS specifies the number of processes to use.  If more than 1, the variables
+are divided among that many worker processes, which transform their variables
+in parallel.  The results are the same as with a single process.  MEMORYLIMIT
+is divided equally among the workers.  The cases are still read and written
+by one process, and each block of values is sent to a worker and back, so
+WORKERS only helps when transforming takes most of the time and there is a
+processor core for each worker: several variables with many distinct values
+and METHOD=HASH or ONETOONE.  For other variables, sending the values takes
+longer than transforming them, and one process is faster.  PROFILE=YES shows
+how much of the time is spent transforming values.
+
+INCREMENTAL names a state file for datasets that only grow by appending cases.
+The first run anonymizes all the cases and saves the mappings, random number
+state, and the number of cases in the state file.  Later runs read the state
+file and anonymize only the cases after that count, which are assumed to be new,
+and VALUEMAPPING is appended with just the new mappings.  MAPPING is not used
+when the state file exists.  Variables are matched to the state by name, and all the
+VARIABLES must be in it, so NAMEROOT cannot be used with INCREMENTAL.
+
+PROFILE=YES reports where the time went: the wall time of each phase of the run,
+cases per second, and, for each variable, the number of new values, the table size,
+and for ONETOONE the values skipped because they were already in use.  The report
+is displayed as pivot tables and, if VALUEMAPPING or BINARYMAPPING is specified,
+also written as json to that file name with .profile.json appended.
+
+CHECKPOINT names a file where the progress of the run is recorded so that a run
+that fails partway, leaving some cases changed and some not, can be finished.
+The mappings and random number state are saved in the file at the start and from
+time to time, and the new values of each block of cases are logged, before the
+cases are changed, in the same file name with .log appended.  To finish the run,
+repeat the command with the same specifications and RESUME=YES on the same
+dataset, without reopening it.  The run continues with the first block not done,
+and the results are the same as if the run had not failed.  The files are deleted
+when the run completes.  CHECKPOINT cannot be used with INCREMENTAL or BATCH.
+
+MAPPINGDB names an SQLite database file that keeps the value mappings and random
+number state of each variable from run to run, so that a value gets the same new
+value in every run that uses the file, as with MAPPING, but the mappings are not
+all read into memory.  The values of each block of cases are looked up in the
+file together, recently used mappings are kept in memory, and the new mappings
+are added to the file after each block.  The file is created if it does not
+exist.  Variables are matched by name.  Only the SEQUENTIAL and RANDOM methods
+use it.  ONETOONE variables still read all their new values from the file to keep
+them unique.  MAPPINGDB cannot be used with INCREMENTAL or CHECKPOINT.
+
+BATCH anonymizes several datasets with the same mappings, so that a value that
+occurs in more than one of them, such as a patient id, gets the same new value in
+all of them.  The mappings are kept in memory from one dataset to the next, and
+VALUEMAPPING and BINARYMAPPING are written once at the end with the mappings for
+all the datasets.  FILES lists sav files to anonymize.  Each is opened, anonymized,
+and saved under the same name in the OUTDIR directory, which must be different from
+the input directory.  If the active dataset has no name, it is given one so that
+it is not replaced.  DATASETS lists open datasets to anonymize in place.  All the
+VARIABLES must be in every dataset, and the datasets are processed one at a time;
+WORKERS divides the variables of each dataset among processes as usual.  NAMEMAPPING
+and INCREMENTAL cannot be used with BATCH.
+
+STREAM=YES reads the FILES directly in blocks of cases and writes the anonymized
+cases to the new files without opening them in Statistics, so the memory used does
+not depend on the size of the files.  It requires the savReaderWriter Python module.
+Variable and value labels, missing values, formats, and measurement levels are
+carried over, but other dictionary information such as variable and multiple
+response sets is not.  The active dataset is not affected.  The anonfile function
+in this module does the same for a single file and can be used from Python
+outside Statistics.
+
 There are side effects to this command.  Value labels and missing value definitions
-are cleared, since they no longer apply.  You can anonymize date-format variables, but the
+are cleared, since they no longer apply.  This, and the renaming for NAMEROOT, is done
+with one VALUE LABELS, MISSING VALUES, and RENAME VARIABLES command for all the
+variables, which appear in the log.  You can anonymize date-format variables, but the
 resulting values will usually not display as the values are not in the valid range for dates.
 Changing the variable type to numeric will allow the values to display.
 
+The command reads and writes each anonymized variable once, apart from the sample of
+up to 10000 cases read for each RANDOM ONETOONE variable and SEQUENTIAL string variable
+whose range might not hold a new value for every case.  If there are pending
+transformations, they are run first, which takes another pass of the data.
+
 /HELP displays this help and does nothing else.
 """
-import spss, spssaux
-from extension import Template, Syntax, processcmd
-import sys, random, re, codecs, csv, io
+import sys, os, random, re, codecs, csv, json, mmap, tempfile, heapq, multiprocessing, time
+import hmac, hashlib
+
+# worker processes (see WorkerPool) do not need, and must not start, the Statistics
+# backend, so they skip these imports.  Outside Statistics, only anonfile can be used
+spss = None
+if os.environ.get("SPSSINC_ANON_WORKER") != "1":
+    try:
+        import spss, spssaux
+        from extension import Template, Syntax, processcmd
+    except ImportError:
+        spss = None
+from array import array
+from bisect import bisect_left
+from itertools import chain, accumulate, islice
 from operator import itemgetter
+from collections import OrderedDict
+from math import nan
+
+# numpy is optional.  If available, it is used to transform numeric blocks in one step
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# savReaderWriter is optional.  It is only needed to anonymize sav files directly
+try:
+    import savReaderWriter
+except ImportError:
+    savReaderWriter = None
+
+# sqlite3 is only needed for MAPPINGDB.  Some Python builds omit it
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
 
 #try:
     #import wingdbstub
@@ -112,50 +256,93 @@ except:
     lineend = "\n"
 
 class DataStep(object):
+    def __init__(self, active=True):
+        """If not active, no data step is started, e.g., for a SavDataset"""
+        self.active = active
+        
     def __enter__(self):
-        """initialization for with statement"""
+        """initialization for with statement
+        
+        A data step cannot start while there are pending transformations.  Only
+        then is EXECUTE submitted to run them, which takes a pass of the data"""
+        if not self.active:
+            return self
         try:
             spss.StartDataStep()
-        except:
+        except spss.SpssError:
+            if spss.IsDataStepInProgress():
+                raise
             spss.Submit("EXECUTE")
             spss.StartDataStep()
         return self
     
     def __exit__(self, type, value, tb):
-        spss.EndDataStep()
+        if self.active:
+            spss.EndDataStep()
         return False
 
 
 
 def anon(varnames, nameroot=None, svalueroot='', method='sequential',
     seed=None, offset=None, scale=None, maxrvalue = None, onetoone=None, 
-    namemapping=None, valuemapping=None, mapping=None, ignorethis=None):
+    namemapping=None, valuemapping=None, mapping=None, ignorethis=None, blocksize=10000,
+    memorylimit=None, workers=1, binarymapping=None, incremental=None, profile=False, key=None,
+    checkpoint=None, resume=False, mappingdb=None, tvars=None, dataset=None):
     """Anonymize the specified variables
     
     varnames is the list of input variables.
     nameroot, if specified, is used as a prefix to rename variables with a numerical suffix.
     svalueroot, if specified, gives a prefix to be prepended to transformed values
     of string variables.
-    method = 'sequential' (default), 'random', or 'transform'.
-    seed, if specified, is used to initialize the random number generator
+    method = 'sequential' (default), 'random', 'transform', or 'hash'.
+    seed, if specified, is used with each variable name to initialize the random number
+    generator for that variable
     offset and scale, required if method=transform, are the parameters for a
     linear transform of the values.  If specified for a string variable , sequential is substituted.
     System-missing values are left as sysmis.
-    maxrvalue is the maximum value for the random method.  Must be positive.  Only applies
-    to random method.
+    maxrvalue is the maximum value for the random and hash methods.  Must be positive.
+    Only applies to those methods.
     Can be one value for all variables or a list the size of the variable list with variable-specific
     values
     onetoone is an option list of variable names, a subset of varnames, for which mapped
-      values must be unique.  Applies only to method random.  If 1-1 mapping cannot be
-      found, an exception is raised.
+      values must be unique.  Applies only to methods random and hash.  If 1-1 mapping
+      cannot be found, an exception is raised.
     namemapping and valuemapping determine whether files with tables of results are saved.
-    mapping names a file written as valuemapping to be used to initialize random mappings.
+    binarymapping, if specified, names a file for the value mappings in binary format.
+    mapping names a file written as valuemapping or binarymapping to be used to initialize
+    random mappings.
+    blocksize is the number of cases read, transformed, and written back at a time.
+    memorylimit, if specified, is the number of megabytes of compacted numeric mapping
+    tables to keep in memory.  Beyond that, tables are moved to temporary files.
+    workers is the number of processes among which the variables are divided.  Each
+    gets an equal share of memorylimit.
+    incremental, if specified, names a state file.  If it exists, the mapping state is
+    restored from it and only cases after the number recorded there are processed,
+    and only new mappings are appended to valuemapping.  The state is saved at the end.
+    Variables are found by name in later runs, so nameroot cannot be used with it.
+    profile = True records the time of each phase and counts for each variable and
+    displays them.
+    key is the secret for the hash method.  It is required for that method.
+    checkpoint, if specified, names a file where the progress of the run is recorded
+    so that it can be resumed after a failure.  See Checkpoint.
+    resume = True continues a failed run from checkpoint.
+    mappingdb, if specified, names an SQLite file that holds the mapping tables and
+    run state across runs instead of memory.  See MappingDatabase.
+    tvars, if specified, is a dictionary of Tvars by lower case variable name.  Variables
+    found there continue with those mappings, and the dictionary is updated with the
+    Tvars of this run.  See anonbatch.
+    dataset, if specified, is used instead of the active dataset.  See anonfile.
     """
     
-    with DataStep():
-        ds = spss.Dataset()
+    prof = Profiler(profile)
+    with DataStep(dataset is None):
+        ds = dataset or spss.Dataset()
         allvariables = ds.varlist
-        varnums = [allvariables[v].index for v in varnames] 
+        # the names are read once, and variables are looked up in this index rather
+        # than through the dataset
+        names = [v.name for v in allvariables]
+        position = dict((name.lower(), i) for i, name in enumerate(names))
+        varnums = [variablenumber(position, v) for v in varnames] 
         numvars = len(varnums)       
         if maxrvalue is None: 
             maxrvalue = [9999999]
@@ -165,64 +352,560 @@ def anon(varnames, nameroot=None, svalueroot='', method='sequential',
             raise ValueError("The number of values for maxrvalue is different from the number of variables")
         if onetoone is None:
             onetoone = []
-        onetoone = set([allvariables[v].index for v in onetoone])
+        onetoone = set([variablenumber(position, v) for v in onetoone])
         if not onetoone.issubset(set(varnums)):
             raise ValueError("A variable is listed in ONETOONE that is not in the VARIABLES list")
-        if seed:
-            random.seed(seed)
-        
+        if blocksize is None or blocksize <= 0:
+            raise ValueError("BLOCKSIZE must be a positive integer")
+        if memorylimit is not None and memorylimit <= 0:
+            raise ValueError("MEMORYLIMIT must be a positive number of megabytes")
+        if workers is None or workers <= 0:
+            raise ValueError("WORKERS must be a positive integer")
+        if resume and not checkpoint:
+            raise ValueError("RESUME requires CHECKPOINT")
+        if checkpoint and (incremental or tvars is not None or dataset is not None):
+            raise ValueError("CHECKPOINT cannot be used with INCREMENTAL or BATCH or when anonymizing a sav file directly")
+        if mappingdb and (incremental or checkpoint):
+            raise ValueError("MAPPINGDB cannot be used with INCREMENTAL or CHECKPOINT")
+        if incremental and nameroot:
+            raise ValueError("NAMEROOT cannot be used with INCREMENTAL")
+        budget = MemoryBudget(memorylimit)
 
-        trflist = [Tvar(allvariables[vn], svalueroot, method, offset, 
-            scale, maxrvalue[i], vn in onetoone) for i, vn in enumerate(varnums)]
-        mapinputs(trflist, mapping)  #initialize mappings if input mapping given
-        todo = list(zip(varnums, trflist))
+        prof.start("initialize and read mappings")
+        trflist = []
+        fresh = []  # Tvars not continued from tvars
+        for i, vn in enumerate(varnums):
+            v = allvariables[vn]
+            t = tvars is not None and tvars.get(v.name.lower()) or None
+            if t is None:
+                t = Tvar(v, svalueroot, method, offset, scale, maxrvalue[i], vn in onetoone, 
+                    budget, seed, key)
+                fresh.append(t)
+            elif t.vtype != v.type:
+                raise ValueError("The type of variable %s is different from an earlier dataset" % v.name)
+            trflist.append(t)
+        # with a mapping database, the tables and run state continue from earlier runs
+        db = mappingdb and MappingDatabase(mappingdb) or None
+        restored = []  # Tvars whose run state was restored from the database
+        if db is not None:
+            for t in fresh:
+                if t.usedatabase(db):
+                    restored.append(t)
+        firstcase = 0
+        partial = None  # a block that a resumed run had not finished
+        ckpt = checkpoint and Checkpoint(checkpoint) or None
+        resumed = incremental and os.path.exists(incremental)
+        if resume:
+            if not os.path.exists(checkpoint):
+                raise ValueError("The checkpoint file was not found: %s" % checkpoint)
+            firstcase, partial = ckpt.resume(trflist, ds, varnums)
+        elif resumed:
+            index = readbinarymapping(trflist, incremental, restorestate=True)
+            missing = set(t.vname for t in trflist) - set(entry["name"] for entry in index["variables"])
+            if missing:
+                raise ValueError("Variables not found in the incremental state file: %s" % 
+                    " ".join(sorted(missing)))
+            firstcase = index["watermark"]
+        else:
+            mapinputs(fresh, mapping)  #initialize mappings if input mapping given
+            if db is not None:
+                for t in fresh:
+                    t.store()
+        if resumed and valuemapping:
+            for t in trflist:
+                t.newkeys = []
 
-        for i, case in enumerate(ds.cases):
-            for vnum, t in todo:
-                ds.cases[i, vnum] = t.trf(case[vnum])
-                
-        # remove now irrelevant value labels and missing value codes
-        for vn in varnums:
-            allvariables[vn].valueLabels = {}
-            allvariables[vn].missingValues = (0, None, None, None)
+        numcases = len(ds.cases)
+        if numcases < firstcase:
+            raise ValueError("The dataset has fewer cases than were recorded in the incremental state file")
+        # check the number of new values against what each variable can hold and pick
+        # the ONETOONE allocators before any case is changed.  Variables continuing from
+        # a state file, a mapping database or an earlier dataset keep their allocator, and
+        # a resumed checkpoint run was checked when it started.  No sample is needed if there is room for
+        # a new value for every case
+        planned = [(vn, t) for vn, t in zip(varnums, trflist) if t.capacity() is not None]
+        if planned and not resume:
+            prof.start("check capacity")
+            for vn, t in planned:
+                allocate = t.onetoone and t in fresh and not t in restored and not resumed
+                if dataset is None and t.capacity() < numcases - firstcase:
+                    t.plan(estimatenew(ds, vn, t, firstcase, numcases), allocate)
+                elif allocate:
+                    # without a sample, as for a SavDataset, which can only be read
+                    # forward, the case count is an upper bound on the new values
+                    t.chooseallocator(numcases - firstcase)
 
-        # rename variables if requested
-        # first find a number that guarantees no name conflicts.
+        # the new names are worked out, and checked, before any case is changed
         if nameroot:
-            basenum = 0
-            pat = re.compile(r"%s(\d+)$" % nameroot, re.IGNORECASE)
-            for v in allvariables:
-                try:
-                    vnum = re.match(pat, v.name).group(1)
-                    basenum = max(basenum, int(vnum))
-                except:
-                    pass
-            basenum += 1   
-            if namemapping:
-                f = codecs.open(namemapping, "w", encoding="utf_8_sig")
-            for vn in varnums:
-                newname = nameroot + str(basenum)
-                if len(newname) > 64:
-                    raise ValueError("A replacement variable name is too long: %s" % newname)
-                if namemapping:
-                    f.write("%s = %s%s" % (allvariables[vn].name, newname, lineend))
-                allvariables[vn].name = newname
-                basenum += 1
-            if namemapping:
-                f.close()
-                print("Variable name mappings written to file: %s" % namemapping)
+            newnames = replacementnames(names, len(varnums), nameroot)
+        else:
+            newnames = None
+        # a SavDataset needs its dictionary before the first cases are written.  For
+        # the active dataset, the dictionary is changed afterwards in a separate step
+        if dataset is not None:
+            prof.start("change dictionary")
+            setmetadata(allvariables, varnums, newnames)
+
+        if ckpt is not None and not resume:
+            prof.start("checkpoint")
+            ckpt.snapshot(trflist, firstcase)
+        todo = list(zip(varnums, trflist))
+        if workers > 1 and numvars > 1:
+            prof.start("start workers")
+            pool = WorkerPool(trflist, workers, budget)
+        else:
+            pool = None
+
+        # read, transform, and write back one column slice per variable per block
+        # rather than one cell at a time.  With a checkpoint, the new values of each column
+        # are logged before they are written.  Variables done in a partial block are skipped
+        blocks = [(start, min(start + blocksize, numcases)) 
+            for start in range(firstcase, numcases, blocksize)]
+        if partial:
+            blocks.insert(0, partial[:2])
+        try:
+            for start, end in blocks:
+                skip = partial and start == partial[0] and partial[2] or ()
+                if pool is None:
+                    for vnum, t in todo:
+                        if t.vname in skip:
+                            continue
+                        prof.start("read cases")
+                        values = [row[0] for row in ds.cases[start:end, vnum]]
+                        prof.start("transform values")
+                        newvalues = t.trfblock(values)
+                        if ckpt is not None:
+                            prof.start("checkpoint")
+                            ckpt.write(start, end, t.vname, t.getrunstate(), values, newvalues)
+                        prof.start("write cases")
+                        ds.cases[start:end, vnum] = newvalues
+                        if ckpt is not None:
+                            ckpt.done(start, t.vname)
+                else:
+                    prof.start("read cases")
+                    columns = [[] if t.vname in skip else [row[0] for row in ds.cases[start:end, vnum]]
+                        for vnum, t in todo]
+                    prof.start("transform values")
+                    newcolumns = pool.trfblock(columns)
+                    if ckpt is not None:
+                        prof.start("checkpoint")
+                        for t, state, values, newvalues in zip(trflist, pool.runstates(), 
+                                columns, newcolumns):
+                            if not t.vname in skip:
+                                ckpt.write(start, end, t.vname, state, values, newvalues)
+                    prof.start("write cases")
+                    for (vnum, t), newvalues in zip(todo, newcolumns):
+                        if not t.vname in skip:
+                            ds.cases[start:end, vnum] = newvalues
+                            if ckpt is not None:
+                                ckpt.done(start, t.vname)
+                if ckpt is not None and ckpt.due():
+                    prof.start("checkpoint")
+                    ckpt.snapshot(pool is None and trflist or pool.gettvars(), end)
+            prof.cases = numcases - (partial and partial[0] or firstcase)
+        except:
+            if pool is not None:
+                pool.terminate()
+            if ckpt is not None:
+                ckpt.close()
+            raise
+        if pool is not None:
+            prof.start("stop workers")
+            trflist = pool.close(wanttables=bool(valuemapping or binarymapping or incremental 
+                or profile or tvars is not None))
+        if tvars is not None:
+            tvars.update((t.vname.lower(), t) for t in trflist)
+                
+        prof.start("write cases")
         ds.close()
         
-        # write file of value mappings for each mapped variable in csv format
-        if valuemapping:
-            #f = codecs.open(valuemapping, "w", encoding="utf_8_sig")
-            #csvout = csv.writer(f)
-            f = file(valuemapping, "w")
-            csvout = UnicodeWriter(f)
-            for t in trflist:
-                t.write(csvout)
-            f.close()
+    # remove now irrelevant value labels and missing value codes and rename variables.
+    # This only changes the dictionary, so it is done with a few commands for all the
+    # variables rather than a change per variable
+    if dataset is None:
+        prof.start("change dictionary")
+        spss.Submit(metadatasyntax([names[vn] for vn in varnums], newnames))
+    if newnames and namemapping:
+        with codecs.open(namemapping, "w", encoding="utf_8_sig") as f:
+            for t, newname in zip(trflist, newnames):
+                f.write("%s = %s%s" % (t.vname, newname, lineend))
+        print("Variable name mappings written to file: %s" % namemapping)
+        
+    # write file of value mappings for each mapped variable in csv format
+    prof.start("write mappings")
+    if valuemapping:
+        writevaluemapping(trflist, valuemapping, append=resumed)
+        if resumed:
+            print("New value mappings appended to file: %s" % valuemapping)
+        else:
             print("Value mappings written to file: %s" % valuemapping)
+    if binarymapping:
+        writebinarymapping(trflist, binarymapping)
+        print("Binary value mappings written to file: %s" % binarymapping)
+    if incremental:
+        # write to a new file first so that a failure leaves the old state intact
+        writebinarymapping(trflist, incremental + ".new", runstate=True, watermark=numcases)
+        os.replace(incremental + ".new", incremental)
+        print("Incremental state for %s cases written to file: %s" % (numcases, incremental))
+    if ckpt is not None:
+        # the run is complete, so there is nothing left to resume
+        ckpt.remove()
+    prof.stop()
+    
+    if profile:
+        if dataset is None:
+            prof.display(trflist)
+        if valuemapping or binarymapping:
+            profilespec = (valuemapping or binarymapping) + ".profile.json"
+            prof.write(trflist, profilespec)
+            print("Profile written to file: %s" % profilespec)
+    if db is not None:
+        # Tvars back from workers have their own connections
+        for t in trflist:
+            if isinstance(t.table, DatabaseTable):
+                t.table.db.close()
+        db.close()
+        print("Value mappings stored in database: %s" % mappingdb)
+
+def estimatenew(ds, vnum, t, firstcase, numcases, blocks=100, blocksize=100):
+    """Return the number of distinct values of variable vnum in cases [firstcase, numcases)
+    that are not in the table of Tvar t as (observed, low, high)
+    
+    blocks blocks of blocksize cases spread evenly over the cases are read.  observed
+    is the count in the sample.  low and high are the smaller and larger of two
+    estimates for all the cases: the first-order jackknife, which tends to be low for
+    skewed distributions, and Shlosser's, which tends to be high for uniform ones"""
+    
+    total = numcases - firstcase
+    if total <= 0:
+        return (0, 0, 0)
+    if blocks * blocksize >= total:
+        starts = [firstcase]
+        blocksize = total
+    else:
+        step = total // blocks
+        starts = [firstcase + i * step for i in range(blocks)]
+    counts = {}
+    sampled = 0
+    for start in starts:
+        values = [row[0] for row in ds.cases[start:start + blocksize, vnum]]
+        sampled += len(values)
+        for value in values:
+            counts[value] = counts.get(value, 0) + 1
+    newcounts = [count for value, count in counts.items() if not value in t.table]
+    observed = len(newcounts)
+    if sampled >= total or not observed:
+        return (observed, observed, observed)
+    q = sampled / float(total)
+    freq = {}   # number of new values seen i times
+    for count in newcounts:
+        freq[count] = freq.get(count, 0) + 1
+    f1 = freq.get(1, 0)
+    num = sum(f * (1 - q) ** i for i, f in freq.items())
+    den = sum(i * q * (1 - q) ** (i - 1) * f for i, f in freq.items())
+    shlosser = observed + f1 * num / den
+    jackknife = observed / (1 - (1 - q) * f1 / float(sampled))
+    return (observed, min(shlosser, jackknife, total), min(max(shlosser, jackknife), total))
+
+def variablenumber(position, name):
+    """Return the index of variable name from position, a dictionary of indexes by
+    lower case name"""
+    
+    try:
+        return position[name.lower()]
+    except KeyError:
+        raise ValueError("Variable not found: %s" % name)
+
+def replacementnames(names, count, nameroot):
+    """Return a list of count new names given the existing variable names
+    
+    The names are nameroot followed by a number larger than that of any existing
+    name of that form, so that there are no conflicts"""
+    
+    pat = re.compile(r"%s(\d+)$" % re.escape(nameroot), re.IGNORECASE)
+    basenum = max([int(m.group(1)) for m in map(pat.match, names) if m], default=0) + 1
+    newnames = [nameroot + str(basenum + i) for i in range(count)]
+    for newname in newnames:
+        if len(newname) > 64:
+            raise ValueError("A replacement variable name is too long: %s" % newname)
+    return newnames
+
+def metadatasyntax(oldnames, newnames=None):
+    """Return the lines of syntax that clear the value labels and missing values of
+    the variables oldnames and, if newnames, rename them
+    
+    Each command lists all the variables, so there are at most three commands
+    however many variables there are"""
+    
+    lines = syntaxlines(["VALUE", "LABELS"] + oldnames + ["."])
+    lines.extend(syntaxlines(["MISSING", "VALUES"] + oldnames + ["()."]))
+    if newnames:
+        lines.extend(syntaxlines(["RENAME", "VARIABLES", "("] + oldnames + ["="] + newnames 
+            + [")."]))
+    return lines
+
+def syntaxlines(words, width=80):
+    """Join words into lines of about width characters"""
+    
+    lines, line = [], []
+    length = 0
+    for word in words:
+        if line and length + len(word) + 1 > width:
+            lines.append(" ".join(line))
+            line, length = [], 0
+        line.append(word)
+        length += len(word) + 1
+    lines.append(" ".join(line))
+    return lines
+
+def setmetadata(allvariables, varnums, newnames=None):
+    """Clear the value labels and missing values of varnums and rename them if newnames"""
+    
+    for vn in varnums:
+        allvariables[vn].valueLabels = {}
+        allvariables[vn].missingValues = (0, None, None, None)
+    if newnames:
+        for vn, newname in zip(varnums, newnames):
+            allvariables[vn].name = newname
+
+def anonbatch(varnames, files=None, datasets=None, outdir=None, stream=False, namemapping=None, 
+    valuemapping=None, binarymapping=None, incremental=None, **kwds):
+    """Anonymize several datasets with shared mappings
+    
+    files is a list of sav files to anonymize.  Each is saved with the same name in
+    directory outdir.  If stream, the files are read and written directly by anonfile
+    instead of being opened in Statistics.
+    datasets is a list of open datasets to anonymize in place.
+    The mappings of each variable carry over from one dataset to the next, and
+    valuemapping and binarymapping are written once for all of them.
+    The other arguments are as for anon."""
+    
+    if bool(files) == bool(datasets):
+        raise ValueError("BATCH requires either FILES or DATASETS")
+    if files and not outdir:
+        raise ValueError("BATCH FILES requires OUTDIR")
+    if namemapping or incremental:
+        raise ValueError("NAMEMAPPING and INCREMENTAL cannot be used with BATCH")
+    tvars = {}
+    active = stream and "*" or spss.ActiveDataset()
+    if stream:
+        if not files:
+            raise ValueError("STREAM requires FILES")
+        for filespec in files:
+            outfile = os.path.join(outdir, os.path.basename(filespec))
+            if os.path.abspath(outfile) == os.path.abspath(filespec):
+                raise ValueError("OUTDIR must be different from the directory of the input file: %s" 
+                    % filespec)
+            anonfile(filespec, outfile, varnames, tvars=tvars, **kwds)
+            print("Anonymized file saved as: %s" % outfile)
+    elif files:
+        if active == "*":
+            active = "anonbatchactive"
+            spss.Submit("DATASET NAME %s WINDOW=ASIS." % active)
+        for filespec in files:
+            outfile = os.path.join(outdir, os.path.basename(filespec))
+            if os.path.abspath(outfile) == os.path.abspath(filespec):
+                raise ValueError("OUTDIR must be different from the directory of the input file: %s" 
+                    % filespec)
+            spss.Submit(['GET FILE="%s".' % filespec.replace('"', '""'), 
+                "DATASET NAME anonbatch WINDOW=ASIS."])
+            anon(varnames, tvars=tvars, **kwds)
+            spss.Submit(['SAVE OUTFILE="%s".' % outfile.replace('"', '""'), 
+                "DATASET CLOSE anonbatch."])
+            print("Anonymized file saved as: %s" % outfile)
+    else:
+        for name in datasets:
+            spss.Submit("DATASET ACTIVATE %s WINDOW=ASIS." % name)
+            anon(varnames, tvars=tvars, **kwds)
+            print("Anonymized dataset: %s" % name)
+    if active != "*":
+        spss.Submit("DATASET ACTIVATE %s WINDOW=ASIS." % active)
+    
+    trflist = list(tvars.values())
+    if valuemapping:
+        writevaluemapping(trflist, valuemapping)
+        print("Value mappings written to file: %s" % valuemapping)
+    if binarymapping:
+        writebinarymapping(trflist, binarymapping)
+        print("Binary value mappings written to file: %s" % binarymapping)
+    for t in trflist:
+        if isinstance(t.table, DatabaseTable):
+            t.table.db.close()
+
+def anonfile(infile, outfile, varnames, **kwds):
+    """Anonymize sav file infile into a new sav file outfile
+    
+    The cases are read and written in blocks using savReaderWriter, so memory does not
+    grow with the size of the file, and Statistics is not needed.  The other arguments
+    are as for anon, except that incremental is not allowed, since the whole output
+    file is written"""
+    
+    if savReaderWriter is None:
+        raise ImportError("The savReaderWriter module is required to anonymize sav files directly")
+    if kwds.get("incremental"):
+        raise ValueError("INCREMENTAL cannot be used when anonymizing a sav file directly")
+    if os.path.abspath(infile) == os.path.abspath(outfile):
+        raise ValueError("The output file must be different from the input file")
+    ds = SavDataset(infile, outfile)
+    try:
+        anon(varnames, dataset=ds, **kwds)
+    finally:
+        ds.release()
+
+class SavDataset(object):
+    """Enough of spss.Dataset for anon over a sav file that is copied to a new file
+    
+    Cases are read forward from the input file one block at a time.  The block is
+    written to the output file, with any changes, when the next block is read or the
+    dataset is closed.  Names, value labels, and missing values must be changed before
+    the first block is written, since they go in the output file dictionary"""
+    
+    def __init__(self, infile, outfile):
+        self.outfile = outfile
+        header = savReaderWriter.SavHeaderReader(infile, ioUtf8=True)
+        try:
+            self.meta = header.all()
+        finally:
+            header.close()
+        self.reader = savReaderWriter.SavReader(infile, ioUtf8=True)
+        self.records = iter(self.reader)
+        self.varlist = SavVariableList(self.meta.varNames, self.meta.varTypes)
+        self.cases = SavCaseList(self, self.reader.shape.nrows)
+        self.writer = None
+        self.block = []
+        self.start = 0
+        
+    def getblock(self, start, end):
+        """Return the records of cases [start, end), reading them if necessary"""
+        
+        if start != self.start or not self.block:
+            if start != self.start + len(self.block):
+                raise ValueError("Cases of a sav file can only be read in order")
+            self.flush()
+            self.block = [list(record) for record in islice(self.records, end - start)]
+            self.start = start
+        return self.block
+    
+    def flush(self):
+        """Write the current block"""
+        
+        if self.writer is None:
+            self.writer = self.makewriter()
+        self.writer.writerows(self.block)
+        self.start += len(self.block)
+        self.block = []
+        
+    def makewriter(self):
+        """Open the output file with the input dictionary, changed as for varlist"""
+        
+        meta = self.meta
+        newnames = dict((old, v.name) for old, v in zip(meta.varNames, self.varlist))
+        def renamed(d, drop=()):
+            return dict((newnames[name], value) for name, value in d.items() 
+                if name in newnames and not name in drop)
+        return savReaderWriter.SavWriter(self.outfile, [v.name for v in self.varlist],
+            renamed(meta.varTypes), valueLabels=renamed(meta.valueLabels, self.varlist.nolabels),
+            varLabels=renamed(meta.varLabels), formats=renamed(meta.formats),
+            missingValues=renamed(meta.missingValues, self.varlist.nomissing),
+            measureLevels=renamed(meta.measureLevels), columnWidths=renamed(meta.columnWidths),
+            alignments=renamed(meta.alignments), varAttributes=renamed(meta.varAttributes),
+            fileLabel=meta.fileLabel or None, caseWeightVar=newnames.get(meta.caseWeightVar),
+            ioUtf8=True)
+    
+    def close(self):
+        """Write the remaining cases and close the files"""
+        
+        while True:
+            self.flush()
+            self.block = [list(record) for record in islice(self.records, 10000)]
+            if not self.block:
+                break
+        self.release()
+        
+    def release(self):
+        for f in (self.writer, self.reader):
+            if f is not None:
+                f.close()
+        self.writer = self.reader = None
+
+class SavVariable(object):
+    """A variable of a SavDataset.  Setting valueLabels or missingValues clears them"""
+    
+    def __init__(self, varlist, index, name, vtype):
+        self.varlist = varlist
+        self.index = index
+        self.name = name
+        self.type = vtype
+        
+    @property
+    def valueLabels(self):
+        return {}
+    
+    @valueLabels.setter
+    def valueLabels(self, value):
+        self.varlist.nolabels.add(self.varlist.names[self.index])
+        
+    @property
+    def missingValues(self):
+        return (0, None, None, None)
+    
+    @missingValues.setter
+    def missingValues(self, value):
+        self.varlist.nomissing.add(self.varlist.names[self.index])
+
+class SavVariableList(object):
+    """The variables of a SavDataset by index or case-insensitive name"""
+    
+    def __init__(self, names, types):
+        self.names = list(names)
+        self.variables = [SavVariable(self, i, name, types[name]) for i, name in enumerate(names)]
+        self.index = dict((name.lower(), v) for name, v in zip(names, self.variables))
+        self.nolabels = set()   # original names of variables with labels cleared
+        self.nomissing = set()
+        
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self.variables[key]
+        try:
+            return self.index[key.lower()]
+        except KeyError:
+            raise ValueError("Variable not found in sav file: %s" % key)
+    
+    def __iter__(self):
+        return iter(self.variables)
+    
+    def __len__(self):
+        return len(self.variables)
+
+class SavCaseList(object):
+    """SavDataset.cases: supports cases[start:end, k] reads and writes for anon"""
+    
+    def __init__(self, ds, numcases):
+        self.ds = ds
+        self.numcases = numcases
+        
+    def __len__(self):
+        return self.numcases
+    
+    def __getitem__(self, key):
+        rows, k = key
+        return [(record[k],) for record in self.ds.getblock(rows.start, rows.stop)]
+    
+    def __setitem__(self, key, values):
+        rows, k = key
+        for record, value in zip(self.ds.getblock(rows.start, rows.stop), values):
+            record[k] = value
+
+def writevaluemapping(trflist, filespec, append=False):
+    """Write the value mappings of trflist to filespec in csv format
+    
+    If append, the mappings are added to the end of the file"""
+    
+    with open(filespec, append and "a" or "w", newline="", encoding="utf-8", 
+            buffering=1024 * 1024) as f:
+        csvout = csv.writer(f)
+        for t in trflist:
+            t.write(csvout)
 
 def mapinputs(trflist, mapping):
     """Initialize mappings from file if given and method is Random
@@ -231,56 +914,382 @@ def mapinputs(trflist, mapping):
     mapping is the filespec for a previously written value mapping file
     Any previously mapped variables (method != transform) have their
     mapping table initialized to the previous mapping
+    Rows for variables not in trflist are skipped, and the rows for a variable
+    are converted and added to its table in chunks.  If trflist is empty, e.g.,
+    for the later datasets of a batch, the file is not read.
     """
     
-    if mapping is None:
+    if mapping is None or not trflist:
+        return
+    if isbinarymapping(mapping):
+        readbinarymapping(trflist, mapping)
         return
-    f = file(mapping)
-    fin = UnicodeReader(f)
-    anonvars = dict([(t.vname, i) for i, t in enumerate(trflist)])  #mapped vars and Tvar index
+    anonvars = dict([(t.vname, t) for t in trflist])  #mapped vars and Tvar objects
     mappedvars = []
-    try:
-        row = next(fin)
-        while True:
-            if len(row) != 1:
+    t = None
+    header = False
+    rows = []
+    with open(mapping, newline="", encoding="utf_8_sig") as f:
+        for row in csv.reader(f):
+            if len(row) > 1:
+                if not header:
+                    raise ValueError("Invalid format for mapping file")
+                if t is not None:
+                    rows.append(row)
+                    if len(rows) >= mappingchunk:
+                        loadmappingrows(t, rows)
+                        rows = []
+            elif len(row) == 1:
+                # header record for the next variable
+                if t is not None:
+                    loadmappingrows(t, rows)
+                    rows = []
+                header = True
+                t = anonvars.get(row[0])
+                if t is not None:
+                    mappedvars.append(t.vname)
+            else:
                 raise ValueError("Invalid format for mapping file")
-            index = anonvars.get(row[0], -1)  # index of Tvar object
-            t = index >= 0 and trflist[index] or None
-            if t:
-                mappedvars.append(t.vname)
-            row = next(fin)
-            maxseqvalue = -1
-            while len(row) > 1:
-                if t:
-                    # for numeric variables, empty string must be mapped to None,
-                    # the output value (row[0]) mapped to int, and the input value to float
-                    # csv writes None values as empty strings :-(
-                    if t.vtype == 0:   # numeric
-                        if row[0] in ["", None]: 
-                            row[0] = None
-                        else:
-                            row[0] = int(row[0])
-                        if row[2] in ["", "None"]: 
-                            row[2] = None
-                        else:
-                            row[2] = float(row[2])
-                        maxseqvalue = max(maxseqvalue, row[0])  # ok with None input
+        if t is not None:
+            loadmappingrows(t, rows)
+    print("Mappings initialized from file: %s\nVariables:\n" % mapping + "\n".join(mappedvars))
+
+# number of mapping file rows converted at a time
+mappingchunk = 100000
+
+def loadmappingrows(t, rows):
+    """Add rows of a csv mapping file to the table of Tvar t
+    
+    rows are lists of mapped value, "=", and input value.
+    For numeric variables, empty strings are sysmis and are mapped to None,
+    the mapped value is converted to int and the input value to float.
+    csv writes None values as empty strings.
+    The sequence number is set to at least the largest mapped value"""
+    
+    if not rows:
+        return
+    newvalues = [row[0] for row in rows]
+    keys = [row[2] for row in rows]
+    if t.vtype == 0:   # numeric
+        newvalues = [int(v) if v else None for v in newvalues]
+        keys = [None if k in ("", "None") else float(k) for k in keys]
+        maxseqvalue = max([v for v in newvalues if v is not None], default=-1)
+    elif t.method == "sequential":
+        maxseqvalue = max([int(m.group(0)) 
+            for m in map(trailingdigits.search, newvalues) if m], default=-1)
+    else:
+        maxseqvalue = -1   # the sequence number is only used by the sequential method
+    t.table.update(zip(keys, newvalues))
+    t.seq = max(t.seq, maxseqvalue)
+
+# Binary mapping file layout: the magic bytes, then the columns of each variable as
+# raw arrays, then a json index describing where each column is and its type code,
+# and finally the position of the index as an 8-byte little-endian integer.
+# Numeric keys are doubles sorted ascending and values are 64-bit integers.  String
+# columns are an array of character offsets followed by the utf-8 text.
+# Entries that do not fit these arrays, such as a sysmis key, are listed in the index.
+binarymagic = b"ANONMAP\x01"
+
+def isbinarymapping(filespec):
+    """Return True if filespec is a binary mapping file"""
+    
+    with open(filespec, "rb") as f:
+        return f.read(len(binarymagic)) == binarymagic
+
+def writebinarymapping(trflist, filespec, runstate=False, watermark=None):
+    """Write the value mappings of all the variables in binary format
+    
+    trflist is the list of transformation objects
+    filespec is the output file
+    If runstate, the random number and sequence state of each variable is included,
+    and watermark, the number of cases processed, is recorded"""
+    
+    index = {"byteorder": sys.byteorder, "variables": [], "watermark": watermark}
+    with open(filespec, "wb") as f:
+        f.write(binarymagic)
+        for t in trflist:
+            entry = {"name": t.vname, "type": t.vtype, "seq": t.maxsequence(), 
+                "count": len(t.table), "extras": []}
+            if runstate:
+                entry["state"] = t.getrunstate()
+            table = t.table
+            if t.vtype == 0:
+                if isinstance(table, CompactTable):
+                    items = table.sorteditems()
+                else:
+                    items = sorted((k, v) for k, v in table.items() if k is not None)
+                keys, values = array('d'), array('q')
+                for k, v in items:
+                    if type(v) is int:
+                        keys.append(k)
+                        values.append(v)
                     else:
-                        maxseqvalue = max(maxseqvalue, int(re.search(trailingdigits,row[0]).group(0)))
-                    t.table[row[2]] = row[0]
-                    if t.onetoone:
-                        t.valueset.add(row[0])
-                    t.seq = maxseqvalue
-                row = next(fin)
+                        entry["extras"].append([k, v])
+                if None in table:
+                    entry["extras"].append([None, table[None]])
+                entry["keys"] = writecolumn(f, keys)
+                entry["values"] = writecolumn(f, values)
+            else:
+                entry["keys"] = writecolumn(f, list(table.keys()))
+                entry["values"] = writecolumn(f, list(table.values()))
+            index["variables"].append(entry)
+        indexpos = f.tell()
+        f.write(json.dumps(index).encode("utf-8"))
+        f.write(indexpos.to_bytes(8, "little"))
+
+def writecolumn(f, column):
+    """Write an array or a list of strings to binary file f and return its description"""
+    
+    if isinstance(column, array):
+        desc = {"code": column.typecode, "pos": f.tell(), "count": len(column)}
+        column.tofile(f)
+        return desc
+    offsets = array('q', chain([0], accumulate(map(len, column))))
+    text = "".join(column).encode("utf-8")
+    desc = {"code": "str", "pos": f.tell(), "count": len(column), "size": len(text)}
+    offsets.tofile(f)
+    f.write(text)
+    return desc
+
+def readcolumn(f, desc, swap):
+    """Read a column written by writecolumn from binary file f
+    
+    swap indicates that the file was written with the other byte order"""
+    
+    f.seek(desc["pos"])
+    if desc["code"] == "str":
+        offsets = array('q')
+        offsets.fromfile(f, desc["count"] + 1)
+        if swap:
+            offsets.byteswap()
+        text = f.read(desc["size"]).decode("utf-8")
+        return [text[offsets[i]:offsets[i+1]] for i in range(desc["count"])]
+    column = array(desc["code"])
+    column.fromfile(f, desc["count"])
+    if swap:
+        column.byteswap()
+    return column
 
-    except StopIteration:
-        print("Mappings initialized from file: %s\nVariables:\n" % mapping + "\n".join(mappedvars))
+def readbinarymapping(trflist, mapping, restorestate=False):
+    """Initialize mappings from a binary mapping file and return its index
+    
+    trflist is the list of transformation objects
+    mapping is the filespec for a file written by writebinarymapping
+    If restorestate, the random number and sequence state saved with the mappings
+    is restored as well.
+    Only the columns of variables in trflist are read"""
+    
+    anonvars = dict([(t.vname, t) for t in trflist])
+    mappedvars = []
+    with open(mapping, "rb") as f:
+        f.seek(-8, 2)
+        indexpos = int.from_bytes(f.read(8), "little")
+        f.seek(indexpos)
+        index = json.loads(f.read()[:-8].decode("utf-8"))
+        swap = index["byteorder"] != sys.byteorder
+        for entry in index["variables"]:
+            t = anonvars.get(entry["name"])
+            if t is None:
+                continue
+            if (entry["type"] == 0) != (t.vtype == 0):
+                raise ValueError("The type of variable %s differs from the mapping file" % t.vname)
+            mappedvars.append(t.vname)
+            keys = readcolumn(f, entry["keys"], swap)
+            values = readcolumn(f, entry["values"], swap)
+            if isinstance(t.table, CompactTable) and len(t.table) == 0 and len(keys) > 0:
+                t.table.addrun(SortedRun(keys, values))
+            else:
+                t.table.update(zip(keys, values))
+            t.table.update([tuple(item) for item in entry["extras"]])
+            t.seq = max(t.seq, entry["seq"])
+            if restorestate:
+                t.setrunstate(entry["state"])
+    print("Mappings initialized from file: %s\nVariables:\n" % mapping + "\n".join(mappedvars))
+    return index
+
+class Checkpoint(object):
+    """Snapshot and write-ahead log of a run so that it can be resumed after a failure
+    
+    The snapshot, filespec, is a binary mapping file with the run state of each
+    variable, and its watermark is the number of cases done (see writebinarymapping).
+    The log, filespec + ".log", has a json line for each variable and block after
+    that, with the distinct values of the block and their new values, the run
+    state of the variable after the block, and digests of the old and new values.
+    The line is written before the new values are written to the dataset and is
+    followed by a done line once they are.  A new snapshot replaces the log when the
+    log has grown larger than the snapshot."""
+    
+    minlog = 16 * 1024 * 1024   # bytes of log before a new snapshot is considered
+    
+    def __init__(self, filespec):
+        self.filespec = filespec
+        self.logspec = filespec + ".log"
+        self.log = None
+        self.snapshotsize = 0
+        self.last = {}   # variable name -> (start, end, digest) of its last logged block
+        
+    def snapshot(self, trflist, watermark):
+        """Write a snapshot of the Tvars in trflist with the cases before watermark done
+        and start a new log
+        
+        The log starts with the digests of the last block of each variable so that
+        resume can check that it has the dataset that the run was changing"""
+        
+        self.close()
+        writebinarymapping(trflist, self.filespec + ".new", runstate=True, watermark=watermark)
+        os.replace(self.filespec + ".new", self.filespec)
+        self.snapshotsize = os.path.getsize(self.filespec)
+        self.log = open(self.logspec, "w", encoding="utf-8")
+        if self.last:
+            self.log.write(json.dumps({"check": 
+                [[name] + list(last) for name, last in self.last.items()]}) + "\n")
+            self.log.flush()
+        
+    def due(self):
+        """Return True if it is time for a new snapshot"""
+        
+        return self.log.tell() > max(self.snapshotsize, self.minlog)
+    
+    def write(self, start, end, name, state, values, newvalues):
+        """Log the new values of variable name for cases [start, end)
+        
+        state is the run state of the variable after the block.  The line is flushed
+        so that it is in the file before the dataset is changed"""
         
+        entry = {"start": start, "end": end, "name": name, "state": state, 
+            "old": columndigest(values), "new": columndigest(newvalues)}
+        # only these methods keep a table.  The others are recomputed if needed
+        if state["method"] in ["sequential", "random"]:
+            pairs = dict(zip(values, newvalues))
+            entry["keys"] = list(pairs.keys())
+            entry["values"] = list(pairs.values())
+        self.log.write(json.dumps(entry) + "\n")
+        self.log.flush()
+        self.last[name] = (start, end, entry["new"])
         
+    def done(self, start, name):
+        """Record that the new values of variable name for the block at start are written"""
+        
+        self.log.write(json.dumps({"done": [start, name]}) + "\n")
+        
+    def resume(self, trflist, ds, varnums):
+        """Restore the Tvars in trflist from the snapshot and log and return 
+        (firstcase, partial)
+        
+        A logged block that is not marked done is written again from the log if the
+        dataset still has the old values.  firstcase is the first case of the first
+        block not started, and partial is None or (start, end, names) for a block that
+        only the variables in names have done.  The log is kept and appended to"""
+        
+        index = readbinarymapping(trflist, self.filespec, restorestate=True)
+        names = set(t.vname for t in trflist)
+        if names != set(entry["name"] for entry in index["variables"]):
+            raise ValueError("RESUME requires the same VARIABLES as the run that wrote the checkpoint")
+        watermark = index["watermark"]
+        if len(ds.cases) < watermark:
+            raise ValueError("The dataset has fewer cases than were recorded in the checkpoint file")
+        tvars = dict((t.vname, (vn, t)) for vn, t in zip(varnums, trflist))
+        
+        # a line cut short by the failure is dropped from the log
+        entries, done, size = [], set(), 0
+        if os.path.exists(self.logspec):
+            with open(self.logspec, "rb") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line.decode("utf-8"))
+                    except ValueError:
+                        break
+                    size += len(line)
+                    if "check" in record:
+                        for name, start, end, digest in record["check"]:
+                            self.last[name] = (start, end, digest)
+                    elif "done" in record:
+                        done.add(tuple(record["done"]))
+                    elif record["start"] >= watermark:   # else from before the snapshot
+                        entries.append(record)
+        self.log = open(self.logspec, "a", encoding="utf-8")
+        self.log.truncate(size)
+        self.log.seek(size)
+        self.snapshotsize = os.path.getsize(self.filespec)
+        
+        checked = set()
+        for entry in entries:
+            start, end, name = entry["start"], entry["end"], entry["name"]
+            if name not in tvars:
+                raise ValueError("RESUME requires the same VARIABLES as the run that wrote the checkpoint")
+            vn, t = tvars[name]
+            if not (start, name) in done:
+                values = [row[0] for row in ds.cases[start:end, vn]]
+                digest = columndigest(values)
+                if digest == entry["old"] and digest != entry["new"]:
+                    if "keys" in entry:
+                        pairs = dict(zip(entry["keys"], entry["values"]))
+                        newvalues = [pairs[value] for value in values]
+                    else:
+                        newvalues = t.trfblock(values)
+                    ds.cases[start:end, vn] = newvalues
+                elif digest != entry["new"]:
+                    raise ValueError("The values of variable %s in cases %s to %s are not those recorded in the checkpoint file, so the run cannot be resumed"
+                        % (name, start + 1, end))
+                self.done(start, name)
+                checked.add(name)
+            if "keys" in entry:
+                table = t.table
+                table.update([(k, v) for k, v in zip(entry["keys"], entry["values"]) 
+                    if not k in table])
+            t.setrunstate(entry["state"])
+            self.last[name] = (start, end, entry["new"])
+            
+        # the last block done for each variable must have its new values, or this is
+        # not the dataset that the run was changing
+        for name, (start, end, digest) in self.last.items():
+            if not name in checked:
+                vn, t = tvars[name]
+                if columndigest([row[0] for row in ds.cases[start:end, vn]]) != digest:
+                    raise ValueError("The dataset does not have the values recorded in the checkpoint file for variable %s, so the run cannot be resumed"
+                        % name)
+        self.log.flush()
+        print("Run resumed from checkpoint file: %s" % self.filespec)
+        
+        blocks = {}
+        for entry in entries:
+            blocks.setdefault((entry["start"], entry["end"]), set()).add(entry["name"])
+        if not blocks:
+            return watermark, None
+        start, end = max(blocks)
+        if len(blocks[(start, end)]) == len(trflist):
+            return end, None
+        return end, (start, end, blocks[(start, end)])
+    
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+    
+    def remove(self):
+        """Remove the snapshot and log"""
+        
+        self.close()
+        for filespec in [self.filespec, self.logspec]:
+            if os.path.exists(filespec):
+                os.remove(filespec)
+
+def columndigest(values):
+    """Return a digest of a column of values that is the same after a round trip
+    through the dataset, where numbers are doubles and strings are padded.
+    Sysmis is taken as nan, which the dataset does not otherwise hold"""
+    
+    if values and isinstance(values[0], str):
+        data = "\0".join([value.rstrip() for value in values]).encode("utf-8")
+    else:
+        data = array('d', [nan if value is None else value for value in values]).tobytes()
+    return hashlib.sha256(data).hexdigest()
+
 class Tvar(object):
     """Transform a variable according to specified method"""
 
-    def __init__(self, v, svalueroot, method, offset, scale, maxrvalue, onetoone):
+    def __init__(self, v, svalueroot, method, offset, scale, maxrvalue, onetoone, budget=None,
+            seed=None, key=None):
         attributesFromDict(locals())
         self.vtype = v.type
         self.vname = v.name
@@ -290,11 +1299,30 @@ class Tvar(object):
             self.method = "sequential"
         if method == 'transform' and (offset is None or scale is None):
             raise ValueError("TRANSFORM method requires OFFSET and SCALE to be specified.")
-        if method == "random" and maxrvalue <= 0:
-            raise ValueError("The maximum value for the random method must be positive.")
+        if method in ["random", "hash"] and maxrvalue <= 0:
+            raise ValueError("The maximum value for the random and hash methods must be positive.")
+        if method == "hash":
+            if not key:
+                raise ValueError("HASH method requires KEY to be specified.")
+            self.hashkey = key.encode("utf-8")
+        # each variable has its own random stream so that its values do not depend on
+        # the other variables or the order in which variables are processed.
+        # The stream key is the seed as a float and the name in lower case, since
+        # Statistics names are not case sensitive
+        if seed:
+            self.rng = random.Random("%r/%s" % (float(seed), self.vname.lower()))
+        else:
+            self.rng = random.Random()
         self.rootlen = len(svalueroot)
-        self.table = {}
+        if self.vtype == 0 and not self.method in ["transform", "hash"]:
+            self.table = CompactTable(budget)
+        else:
+            self.table = {}
         self.seq = -1
+        self.newkeys = None  # if a list, new table keys are recorded in it
+        self.newcount = 0    # number of new table entries in this run
+        self.collisions = 0  # ONETOONE draws skipped because the value was in use
+        self.maxprobe = 0    # most draws skipped for a single value
         self.available = v.type - self.rootlen  # char available to random for strings
         # if no room for at least 1 digit, eliminate the prefix
         if self.available < 1:
@@ -302,112 +1330,345 @@ class Tvar(object):
             self.available = self.vtype
         if self.vtype > 0:
             self.maxrvalue = min(maxrvalue, 10 ** min(self.available, 20) - 1)
-        if onetoone:
-            self.valueset = set()
-            self.directionfuncs = [self.up, self.down]
+            self.strings = StringValues(self.svalueroot, self.vtype)
+            self.warned = False  # whether the width warning for sequential has been given
+        if onetoone and self.method == "hash":
+            self.hashed = {}  # new value -> value, to detect collisions
+        elif onetoone:
+            self.valueset = None  # values in use when drawing starts, built when needed
+            self.permutation = Permutation(min(self.maxrvalue, 0xffffffffffffff) + 1,
+                self.rng.getrandbits(64))
+            self.drawn = 0   # number of permutation values used so far
+            self.allocator = "permutation"   # or "rejection".  See plan
+
 
+    def __getstate__(self):
+        """The Statistics variable object and shared budget are not sent to worker processes"""
+        
+        state = self.__dict__.copy()
+        state.pop("v", None)
+        state.pop("budget", None)
+        return state
 
     def sequential(self, value):
         """Transform a value according to sequence"""
-        if value in self.table:
-            return self.table[value]
-        self.seq += 1
-        if self.vtype == 0:
-            self.table[value] = self.seq
-            return self.seq
-        else:
-            sseq = str(self.seq)
-            newvalue = self.svalueroot + sseq
-            if len(newvalue) > self.vtype:
-                newvalue = newvalue[-self.vtype:]
-            self.table[value] = newvalue
-            return newvalue
+        
+        return self.sequentialblock([value])[0]
+
+    def sequentialblock(self, values):
+        """Transform a block of values according to sequence
+        
+        The distinct values of the block are found first, and only those not already
+        in the table are numbered, in order of first appearance, so the numbering
+        does not depend on the block size.  The block is then mapped
+        through the table in one pass"""
+        
+        table = self.table
+        newkeys = [value for value in dict.fromkeys(values) if not value in table]
+        if self.newkeys is not None:
+            self.newkeys.extend(newkeys)
+        self.newcount += len(newkeys)
+        if newkeys:
+            seqs = range(self.seq + 1, self.seq + 1 + len(newkeys))
+            self.seq += len(newkeys)
+            if self.vtype == 0:
+                table.update(zip(newkeys, seqs))
+            else:
+                self.checkwidth()
+                table.update(zip(newkeys, self.strings.values(seqs)))
+        return self.lookup(values)
+    
+    def checkwidth(self):
+        """Warn once if the sequence numbers no longer give distinct strings"""
+        
+        if not self.warned and not self.strings.collisionfree(self.seq + 1):
+            print("Warning: the sequential values for variable %s no longer fit in its width, so they are not all unique"
+                % self.vname)
+            self.warned = True
     
     def transform(self, value):
         """Transform the value according to linear transform"""
         
-        if value is None:
-            return None
-        return value * self.scale + self.offset
+        return self.transformblock([value])[0]
+
+    def transformblock(self, values):
+        """Transform a block of values according to linear transform
+        
+        Uses numpy if available.  Sysmis (None) values are carried through as None.
+        The result is identical with or without numpy"""
+        
+        if numpy is None:
+            return [None if value is None else value * self.scale + self.offset
+                for value in values]
+        arr = numpy.array(values, dtype=numpy.float64)  # None becomes nan
+        missing = numpy.isnan(arr)
+        newvalues = (arr * self.scale + self.offset).tolist()
+        for i in numpy.flatnonzero(missing).tolist():
+            newvalues[i] = None
+        return newvalues
     
     def random(self, value):
         """Transform the value into a random integer"""
         
-        if value in self.table:
-            return self.table[value]
-        rn = random.randint(0, min(self.maxrvalue, 0xffffffffffffff))
-        if self.vtype == 0:
-            ###rn = float(rn)
-            if self.onetoone:
-                rn = self.ensuredistinct(rn)
-            self.table[value] = rn
-            return rn
-        # string variable
-        newvalue = self.svalueroot + str(rn)
-        newvalue = newvalue[-self.vtype:]
+        return self.randomblock([value])[0]
+
+    def randomblock(self, values):
+        """Transform a block of values into random integers
+        
+        Random values are drawn only for distinct values not already in the table,
+        in order of first appearance, so the draws do not depend on the block size.
+        The block is then mapped through the table in one pass"""
+        
+        table = self.table
+        newkeys = [value for value in dict.fromkeys(values) if not value in table]
+        if self.newkeys is not None:
+            self.newkeys.extend(newkeys)
+        self.newcount += len(newkeys)
+        # uniquerandoms fails before any of the block is assigned if it cannot be
+        # mapped one to one
         if self.onetoone:
-            newvalue = self.ensuredistinct(newvalue, re.search(trailingdigits, newvalue).group(0))
-        self.table[value] = newvalue
-        return newvalue
-    
-    def ensuredistinct(self, rn, trailingdigits=None):
-        """Return a unique value or fail
-        trailing digits is expected to be supplied for string values only"""
-        
-        if not rn in self.valueset:
-            self.valueset.add(rn)
-            return rn
-        # search sequentially up and down to find next available value
-        # direction to search first is random to keep the value distribution reasonably uniform
-        random.shuffle(self.directionfuncs)
-        res = self.directionfuncs[0](rn, trailingdigits)
-        if res is None:
-            res = self.directionfuncs[1](rn, trailingdigits)
-        if res is None:
+            table.update(zip(newkeys, self.uniquerandoms(len(newkeys))))
+        elif newkeys:
+            rns = self.draws(len(newkeys))
+            if self.vtype == 0:
+                table.update(zip(newkeys, rns))
+            else:
+                table.update(zip(newkeys, self.strings.values(rns)))
+        return self.lookup(values)
+    
+    def hash(self, value):
+        """Transform the value into a keyed hash"""
+        
+        return self.hashblock([value])[0]
+    
+    def hashblock(self, values):
+        """Transform a block of values into keyed hashes
+        
+        The HMAC-SHA256 of each distinct value is reduced to [0, maxrvalue].  Numbers
+        are hashed as the repr of the float, strings without trailing blanks, and
+        sysmis as an empty string.  For ONETOONE, new values are checked against
+        those seen so far in the run"""
+        
+        mac = hmac.new(self.hashkey, digestmod=hashlib.sha256)
+        size = self.maxrvalue + 1
+        hashed = {}
+        for value in dict.fromkeys(values):
+            if value is None:
+                msg = b""
+            elif self.vtype == 0:
+                msg = repr(float(value)).encode("ascii")
+            else:
+                msg = value.rstrip().encode("utf-8")
+            h = mac.copy()
+            h.update(msg)
+            hashed[value] = int.from_bytes(h.digest()[:8], "big") % size
+        if self.vtype > 0:
+            hashed = dict(zip(hashed.keys(), self.strings.values(hashed.values())))
+        if self.onetoone:
+            seen = self.hashed
+            for value, newvalue in hashed.items():
+                old = seen.setdefault(newvalue, value)
+                if old != value and not (self.vtype > 0 and old.rstrip() == value.rstrip()):
+                    raise ValueError("Values %r and %r of variable %s have the same hash.  "
+                        "Increase MAXRVALUE or use RANDOM" % (old, value, self.vname))
+        return list(map(hashed.__getitem__, values))
+    
+    def draws(self, count):
+        """Return a list of count random integers in [0, maxrvalue]
+        
+        The random bits for the whole list are generated in one call.  Each draw
+        uses the next 64 bits masked to the size of the range and is rejected if out
+        of range, so the values do not depend on how the draws are batched"""
+        
+        size = min(self.maxrvalue, 0xffffffffffffff) + 1
+        mask = (1 << (size - 1).bit_length()) - 1
+        result = []
+        while len(result) < count:
+            need = count - len(result)
+            words = array('Q')
+            words.frombytes(self.rng.getrandbits(64 * need).to_bytes(8 * need, "little"))
+            if sys.byteorder == "big":
+                words.byteswap()
+            if numpy is not None:
+                words = numpy.frombuffer(words, dtype=numpy.uint64) & numpy.uint64(mask)
+                result.extend(words[words < size].tolist())
+            else:
+                result.extend([w for w in [w & mask for w in words] if w < size])
+        return result
+    
+    def uniquerandoms(self, count):
+        """Return a list of count random values not yet used for this variable or fail
+        
+        Values are drawn from a keyed permutation of [0, maxrvalue], so each draw
+        is new apart from values already in the table when drawing starts, e.g.,
+        from a mapping file.  Only those need to be remembered and checked.
+        The draws for the list are made and converted to strings together"""
+        
+        if self.allocator == "rejection":
+            return self.rejectionrandoms(count)
+        permutation = self.permutation
+        if self.valueset is None:
+            if isinstance(self.table, CompactTable):
+                self.valueset = self.table.valueset()
+            else:
+                self.valueset = set(self.table.values())
+        valueset = self.valueset
+        result = []
+        probe = 0
+        while len(result) < count:
+            need = min(count - len(result), permutation.size - self.drawn)
+            if need <= 0:
+                raise ValueError("Cannot find unique value for variable: %s" % self.vname)
+            rns = [permutation[i] for i in range(self.drawn, self.drawn + need)]
+            self.drawn += need
+            if self.vtype > 0:
+                rns = self.strings.values(rns)
+            if not valueset:
+                result.extend(rns)
+                continue
+            for rn in rns:
+                if rn in valueset:
+                    probe += 1
+                    continue
+                if probe:
+                    self.collisions += probe
+                    self.maxprobe = max(self.maxprobe, probe)
+                    probe = 0
+                result.append(rn)
+        return result
+
+    def rejectionrandoms(self, count):
+        """Return a list of count random values not yet used for this variable or fail
+        
+        Values are drawn as for random and those already in use are drawn again.
+        All the values in use are kept in a set.  This is faster than the permutation
+        while less than about half the range is used.  See chooseallocator"""
+        
+        if self.valueset is None:
+            self.valueset = set(self.table.values())
+        valueset = self.valueset
+        if len(valueset) + count > self.maxrvalue + 1:
             raise ValueError("Cannot find unique value for variable: %s" % self.vname)
-        return res
-
-    def up(self, rn, trailingdigits):
-        if trailingdigits is None:
-            for i in range(rn + 1, self.maxrvalue+1):
-                if not i in self.valueset:
-                    self.valueset.add(i)
-                    return i
-            return None
-        else:
-            rnn = int(trailingdigits)
-            prefixlen = len(rn) - len(trailingdigits)
-            root = rn[:prefixlen]
-            for i in range(rnn+1, self.maxrvalue+1):
-                trialvalue = (root + str(i))[-self.vtype:]
-                if not trialvalue in self.valueset:
-                    self.valueset.add(trialvalue)
-                    return trialvalue
-            return None
+        result = []
+        while len(result) < count:
+            rns = self.draws(count - len(result))
+            if self.vtype > 0:
+                rns = self.strings.values(rns)
+            for rn in rns:
+                if rn in valueset:
+                    self.collisions += 1
+                else:
+                    valueset.add(rn)
+                    result.append(rn)
+        return result
     
-    def down(self, rn, trailingdigits):
-        if trailingdigits is None:
-            for i in range(rn-1, -1,-1):
-                if not i in self.valueset:
-                    self.valueset.add(i)
-                    return i
-            return None
-        else:
-            rnn = int(trailingdigits)
-            prefixlen = len(rn) - len(trailingdigits)
-            root = rn[:prefixlen]
-            for i in range(rnn-1, -1, -1):
-                trialvalue = (root + str(i))[-self.vtype:]
-                if not trialvalue in self.valueset:
-                    self.valueset.add(trialvalue)
-                    return trialvalue
-            return None
+    rejectionfill = 0.5   # largest expected fill of the range for the rejection allocator
+    
+    def capacity(self):
+        """Return the number of new values that can still be given distinct new values
+        or None if there is no limit or it does not matter"""
+        
+        if self.onetoone and self.method == "random":
+            return self.maxrvalue + 1 - len(self.table)
+        if self.vtype > 0 and self.method == "sequential":
+            return max(self.strings.capacity - (self.seq + 1), 0)
+        return None
+    
+    def plan(self, estimate, allocate=True):
+        """Check the estimated number of new values against the capacity and, if
+        allocate, choose the ONETOONE allocator
+        
+        estimate is (observed, low, high), the number of distinct new values seen in a
+        sample and a low and a high estimate for all the cases (see estimatenew).
+        For ONETOONE, if the observed count exceeds the capacity, an exception is
+        raised.  The estimates can be far off, so if they do, only a warning is given"""
+        
+        observed, low, high = estimate
+        capacity = self.capacity()
+        if capacity is None:
+            return
+        if self.method == "sequential":
+            if high > capacity:
+                print("Warning: the sequential values for variable %s will probably not all fit in its width"
+                    % self.vname)
+            return
+        if observed > capacity:
+            raise ValueError("Cannot find unique values for variable %s: there are at least %s new values but only %s unused values in the range.  Increase MAXRVALUE"
+                % (self.vname, observed, capacity))
+        if low > capacity:
+            print("Warning: variable %s probably has about %.0f new values but only %s unused values in the range, so ONETOONE will probably fail"
+                % (self.vname, low, capacity))
+        elif high > capacity:
+            print("Warning: variable %s may have up to about %.0f new values but only %s unused values in the range, so ONETOONE may fail"
+                % (self.vname, high, capacity))
+        if allocate:
+            self.chooseallocator(high)
+            
+    def chooseallocator(self, estimated):
+        """Choose the rejection allocator if the range is not expected to be more than
+        rejectionfill full with estimated new values, otherwise the permutation.
+        Nothing changes once values have been drawn.
+        The rejection allocator keeps every value in use in a set, so it is only
+        chosen for string variables.  Numeric variables, whose tables are kept
+        compactly, always use the permutation, whether the table is in memory or
+        in a MappingDatabase"""
+        
+        if self.drawn == 0 and self.valueset is None:
+            fill = (len(self.table) + estimated) / (self.maxrvalue + 1.)
+            if self.vtype > 0 and fill <= self.rejectionfill:
+                self.allocator = "rejection"
+            else:
+                self.allocator = "permutation"
+
+    def lookup(self, values):
+        """Return the mapped values for a list of values that are all in the table"""
+        
+        if isinstance(self.table, (CompactTable, DatabaseTable)):
+            return self.table.getmany(values)
+        return list(map(self.table.__getitem__, values))
 
     def trf(self, value):
         """transform a value for variable and return it
         value is the case value to transform
         """
         return getattr(Tvar, self.method)(self, value)
+
+    def trfblock(self, values):
+        """transform a block of values for variable and return the new values
+        values is the list of case values for a block of cases
+        """
+        stored = isinstance(self.table, DatabaseTable)
+        if stored:
+            self.table.prefetch(values)
+        blockfunc = getattr(Tvar, self.method + "block", None)
+        if blockfunc is not None:
+            newvalues = blockfunc(self, values)
+        else:
+            func = getattr(Tvar, self.method)
+            newvalues = [func(self, value) for value in values]
+        if stored:
+            self.store()
+        return newvalues
+    
+    def usedatabase(self, db):
+        """Keep the table in db, a MappingDatabase, and continue from the run state
+        saved there, if any.  Only the sequential and random methods have a table.
+        Return True if the run state was restored"""
+        
+        if not self.method in ["sequential", "random"]:
+            return False
+        self.table = DatabaseTable(db, self.vname, self.vtype)
+        state = db.getstate(self.vname, self.vtype)
+        if state is None:
+            return False
+        self.setrunstate(state)
+        return True
+    
+    def store(self):
+        """Commit the table and run state if the table is in a database"""
+        
+        if isinstance(self.table, DatabaseTable):
+            self.table.commit(self.getrunstate())
     
     def write(self, f):
         """Write value mapping to file f in csv format
@@ -417,71 +1678,798 @@ class Tvar(object):
         Table is sorted by the mapped value for eas of lookup, but values
         are sorted as strings, so the order is not always the natural one for numbers.
         No values are written for method = transform, since no table is created.
+        If newkeys is being recorded, only those entries are written.
         """
         #f.write("**Variable: %s%s" % (self.vname, lineend))
         f.writerow([self.vname])
-        for k, v in sorted(iter(self.table.items()), key=itemgetter(1)):
-            #f.write("%s\t=%s%s" %(v, k, lineend))
-            f.writerow([str(v), "=", str(k)])
+        if self.newkeys is None:
+            items = iter(self.table.items())
+        else:
+            items = zip(self.newkeys, self.lookup(self.newkeys))
+        f.writerows([str(v), "=", str(k)] 
+            for k, v in sorted(items, key=itemgetter(1)))
+
+    def profile(self):
+        """Return a dictionary of counts for PROFILE"""
+        
+        stats = {"method": self.method, "new values": self.newcount, "table size": len(self.table)}
+        if self.onetoone and self.method != "hash":
+            stats.update({"collisions": self.collisions, "max probe": self.maxprobe,
+                "cycle walks": self.permutation.walks, "allocator": self.allocator})
+        return stats
+
+    def getrunstate(self):
+        """Return the state other than the table needed to continue this mapping later"""
+        
+        state = {"method": self.method, "seq": self.seq, "rng": self.rng.getstate()}
+        if self.onetoone and self.method != "hash":
+            state["drawn"] = self.drawn
+            state["permutation"] = [self.permutation.size, self.permutation.keys]
+            state["allocator"] = self.allocator
+        return state
+    
+    def setrunstate(self, state):
+        """Restore the state returned by getrunstate, e.g., after a json round trip"""
+        
+        if state["method"] != self.method or \
+                ("drawn" in state) != bool(self.onetoone and self.method != "hash"):
+            raise ValueError("The method or ONETOONE setting of variable %s differs from the saved state"
+                % self.vname)
+        self.seq = state["seq"]
+        version, internal, gauss = state["rng"]
+        self.rng.setstate((version, tuple(internal), gauss))
+        if "drawn" in state:
+            size, keys = state["permutation"]
+            if size != self.permutation.size:
+                raise ValueError("The range of values for variable %s differs from the saved state"
+                    % self.vname)
+            self.permutation.keys = keys
+            self.drawn = state["drawn"]
+            self.allocator = state.get("allocator", "permutation")
+
+    def maxsequence(self):
+        """Return the largest sequence number in the mapped values
+        
+        This is the sequence number that mapinputs derives from a csv mapping file"""
+        
+        if self.vtype == 0:
+            return max([v for v in self.table.values() if v is not None], default=-1)
+        return max([int(m.group(0)) 
+            for m in map(trailingdigits.search, self.table.values()) if m], default=-1)
             
             
-class UnicodeWriter:
-    """
-    A CSV writer which will write rows to CSV file "f",
-    which is encoded in the given encoding.
-    """
+class StringValues(object):
+    """Replacement strings for a string variable: the prefix followed by a number
+    
+    The layout is worked out once.  Numbers below fits go after the whole prefix.
+    Longer numbers push the prefix out from the left, and numbers longer than the
+    width lose their leading digits.  capacity is how many numbers, counting from 0,
+    are sure to give distinct strings.  Beyond fits that is only so if the prefix has
+    no digits, since otherwise a shortened prefix and a longer number can give the
+    same string as the whole prefix and a shorter number"""
+    
+    def __init__(self, root, width):
+        self.root = root
+        self.width = width
+        self.fits = 10 ** max(width - len(root), 0)
+        if re.search(r"\d", root):
+            self.capacity = self.fits
+        else:
+            self.capacity = 10 ** width
+            
+    def collisionfree(self, count):
+        """Return whether the numbers 0 to count - 1 all give distinct strings"""
+        
+        return count <= self.capacity
+    
+    def values(self, numbers):
+        """Return the strings for a list or range of nonnegative numbers"""
+        
+        root = self.root
+        if not numbers:
+            return []
+        if max(numbers) < self.fits:
+            return [root + s for s in map(str, numbers)]
+        width = self.width
+        return [(root + s)[-width:] for s in map(str, numbers)]
 
-    def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
-        # Redirect output to a queue
-        self.queue = io.StringIO()
-        self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
-        self.stream = f
-        self.encoder = codecs.getincrementalencoder(encoding)()
-
-    def writerow(self, row):
-        self.writer.writerow([s.encode("utf-8") for s in row])
-        # Fetch UTF-8 output from the queue ...
-        data = self.queue.getvalue()
-        data = data.decode("utf-8")
-        # ... and reencode it into the target encoding
-        data = self.encoder.encode(data)
-        # write to the target stream
-        self.stream.write(data)
-        # empty queue
-        self.queue.truncate(0)
-
-class UTF8Recoder:
-    """
-    Iterator that reads an encoded stream and reencodes the input to UTF-8
-    """
-    def __init__(self, f, encoding):
-        self.reader = codecs.getreader(encoding)(f)
+class Profiler(object):
+    """Wall time by phase for PROFILE
+    
+    start(name) charges the time from now until the next start or stop to the phase.
+    When not enabled, start and stop do nothing"""
+    
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.times = {}
+        self.order = []
+        self.current = None
+        self.cases = 0
+        
+    def start(self, name):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.current is not None:
+            self.times[self.current] += now - self.began
+        if not name in self.times:
+            self.times[name] = 0.
+            self.order.append(name)
+        self.current = name
+        self.began = now
+        
+    def stop(self):
+        if self.enabled and self.current is not None:
+            self.times[self.current] += time.perf_counter() - self.began
+            self.current = None
+            
+    def report(self, trflist):
+        """Return the profile as a dictionary"""
+        
+        total = sum(self.times.values())
+        casetime = sum(self.times.get(name, 0) 
+            for name in ["read cases", "transform values", "write cases"])
+        return {"phases": [[name, self.times[name]] for name in self.order],
+            "total seconds": total, "cases": self.cases,
+            "cases per second": casetime and self.cases / casetime or None,
+            "variables": [[t.vname, t.profile()] for t in trflist]}
+    
+    def write(self, trflist, filespec):
+        with open(filespec, "w", encoding="utf-8") as f:
+            json.dump(self.report(trflist), f, indent=1)
+            
+    def display(self, trflist):
+        """Display the profile as pivot tables"""
+        
+        report = self.report(trflist)
+        total = report["total seconds"] or 1.
+        spss.StartProcedure("SPSSINC ANON")
+        try:
+            pt = spss.BasePivotTable("Run Time by Phase", "ANONPROFILEPHASES",
+                caption="Cases processed: %s.  Cases per second: %s" % 
+                (report["cases"], report["cases per second"] is not None and 
+                "%.0f" % report["cases per second"] or "-"))
+            pt.SimplePivotTable(rowdim="Phase", rowlabels=[name for name, secs in report["phases"]],
+                coldim="", collabels=["Seconds", "Percent"],
+                cells=list(chain(*[[secs, 100. * secs / total] for name, secs in report["phases"]])))
+            columns = ["new values", "table size", "allocator", "collisions", "max probe", "cycle walks"]
+            pt = spss.BasePivotTable("Variable Statistics", "ANONPROFILEVARIABLES")
+            pt.SimplePivotTable(rowdim="Variable", rowlabels=[name for name, stats in report["variables"]],
+                coldim="", collabels=["Method"] + [c.title() for c in columns],
+                cells=list(chain(*[[stats["method"]] + [stats.get(c, "-") for c in columns]
+                    for name, stats in report["variables"]])))
+        finally:
+            spss.EndProcedure()
 
-    def __iter__(self):
-        return self
+class WorkerPool(object):
+    """Worker processes that each own a fixed share of the Tvar objects
+    
+    The main process reads each block of columns and sends each worker its columns.
+    The workers transform them in parallel and send back the new values.
+    Since every Tvar has its own random stream, the results do not depend on
+    how the variables are divided.  If budget, the MemoryBudget of the run, is
+    given, each worker gets an equal share of it for its compact tables."""
+    
+    def __init__(self, tvars, workers, budget=None):
+        workers = min(workers, len(tvars))
+        self.shards = [list(range(i, len(tvars), workers)) for i in range(workers)]
+        self.budget = budget
+        share = budget is not None and budget.share(workers) or None
+        context = multiprocessing.get_context("spawn")
+        # the embedded interpreter's executable is Statistics itself
+        if not os.path.basename(sys.executable).lower().startswith("python"):
+            if sys.platform == "win32":
+                exe = os.path.join(sys.exec_prefix, "python.exe")
+            else:
+                exe = os.path.join(sys.exec_prefix, "bin", "python3")
+            context.set_executable(exe)
+        self.connections = []
+        self.processes = []
+        os.environ["SPSSINC_ANON_WORKER"] = "1"
+        try:
+            for shard in self.shards:
+                conn, childconn = context.Pipe()
+                p = context.Process(target=anonworker, 
+                    args=(childconn, [tvars[i] for i in shard], share))
+                p.daemon = True
+                p.start()
+                childconn.close()
+                self.connections.append(conn)
+                self.processes.append(p)
+        finally:
+            del os.environ["SPSSINC_ANON_WORKER"]
+        self.tvars = tvars
+            
+    def trfblock(self, columns):
+        """Transform a list of columns, one per Tvar, and return the new columns"""
+        
+        for conn, shard in zip(self.connections, self.shards):
+            conn.send([columns[i] for i in shard])
+        result = [None] * len(columns)
+        for conn, shard in zip(self.connections, self.shards):
+            for i, newvalues in zip(shard, self.receive(conn)):
+                result[i] = newvalues
+        return result
+    
+    def runstates(self):
+        """Return the run state of each Tvar"""
+        
+        return self.query("state")
+    
+    def gettvars(self):
+        """Return copies of the Tvars, with their tables, and leave the workers running"""
+        
+        return self.query("tvars")
+    
+    def query(self, msg):
+        """Send msg to each worker and return the list of replies, one per Tvar"""
+        
+        for conn in self.connections:
+            conn.send(msg)
+        result = [None] * len(self.tvars)
+        for conn, shard in zip(self.connections, self.shards):
+            for i, item in zip(shard, self.receive(conn)):
+                result[i] = item
+        return result
+    
+    def receive(self, conn):
+        reply = conn.recv()
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+    
+    def close(self, wanttables=False):
+        """Stop the workers and return the list of Tvars
+        
+        If wanttables, the Tvars, with their tables, are retrieved from the workers"""
+        
+        tvars = list(self.tvars)
+        try:
+            for conn in self.connections:
+                conn.send(wanttables)
+            for conn, shard in zip(self.connections, self.shards):
+                reply = self.receive(conn)
+                if wanttables:
+                    for i, t in zip(shard, reply):
+                        # the tables replace those the run started with in the budget
+                        if self.budget is not None and isinstance(t.table, CompactTable):
+                            old = tvars[i].table
+                            for run in old.runs:
+                                old.release(run)
+                            t.table.setbudget(self.budget)
+                        tvars[i] = t
+        finally:
+            for conn, p in zip(self.connections, self.processes):
+                conn.close()
+                p.join()
+        return tvars
+    
+    def terminate(self):
+        """Stop the workers without waiting for their results"""
+        
+        for conn, p in zip(self.connections, self.processes):
+            p.terminate()
+            p.join()
+            conn.close()
 
-    def __next__(self):
-        return self.reader.next().encode("utf-8")
+def anonworker(conn, tvars, budget=None):
+    """Transform blocks for a list of Tvars in a worker process
+    
+    conn is the connection to the main process.  It sends a list of columns to
+    transform, "state" or "tvars" to get the run states or the Tvars, or, to finish,
+    a bool indicating whether to send back the Tvars.
+    budget, if given, is this worker's MemoryBudget for the compact tables"""
+    
+    try:
+        if budget is not None:
+            for t in tvars:
+                if isinstance(t.table, CompactTable):
+                    t.table.setbudget(budget)
+        while True:
+            msg = conn.recv()
+            if isinstance(msg, bool):
+                conn.send(msg and tvars or None)
+                break
+            if msg == "state":
+                conn.send([t.getrunstate() for t in tvars])
+                continue
+            if msg == "tvars":
+                conn.send(tvars)
+                continue
+            conn.send([t.trfblock(values) for t, values in zip(tvars, msg)])
+    except Exception as e:
+        try:
+            conn.send(e)
+        except (OSError, EOFError):
+            pass
+    conn.close()
 
-class UnicodeReader:
-    """
-    A CSV reader which will iterate over lines in the CSV file "f",
-    which is encoded in the given encoding.
-    """
+class MemoryBudget(object):
+    """Memory allowance shared by the compact tables of a run
+    
+    limit is in megabytes or None for no limit.  used is the number of bytes of
+    compacted runs currently held in memory"""
+    
+    def __init__(self, limit=None):
+        self.limit = limit is not None and limit * 1024 * 1024 or None
+        self.used = 0
+        
+    def allows(self, nbytes):
+        return self.limit is None or self.used + nbytes <= self.limit
+    
+    def share(self, parts):
+        """Return a new budget with an equal share of the limit for one of parts
+        worker processes"""
+        
+        budget = MemoryBudget()
+        if self.limit is not None:
+            budget.limit = self.limit // parts
+        return budget
+
+class SortedRun(object):
+    """Numeric keys and integer values in parallel arrays sorted by key
+    
+    The arrays are either in memory or memory-mapped from temporary files"""
+    
+    itemsize = 16   # bytes per entry
+    
+    def __init__(self, keys, values):
+        self.keys = keys
+        self.values = values
+        self.files = []
+        
+    def __len__(self):
+        return len(self.keys)
+        
+    def index(self, key):
+        """Return the position of key or -1"""
+        
+        keys = self.keys
+        i = bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            return i
+        return -1
+    
+    def __getstate__(self):
+        # memory-mapped arrays are copied so that the run can be pickled
+        keys, values = array('d'), array('q')
+        keys.frombytes(memoryview(self.keys).cast('B'))
+        values.frombytes(memoryview(self.values).cast('B'))
+        return {"keys": keys, "values": values, "files": []}
+        
+    def spill(self):
+        """Move the arrays to temporary files and map them back into memory"""
+        
+        views = []
+        for a in (self.keys, self.values):
+            f = tempfile.TemporaryFile(prefix="anon")
+            a.tofile(f)
+            f.flush()
+            views.append(memoryview(mmap.mmap(f.fileno(), 0)).cast(a.typecode))
+            self.files.append(f)
+        self.keys, self.values = views
 
-    def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
-        f = UTF8Recoder(f, encoding)
-        self.reader = csv.reader(f, dialect=dialect, **kwds)
+class CompactTable(object):
+    """Mapping table for numeric variables that uses little memory when large
+    
+    New entries go into an ordinary dict.  When that holds frontlimit entries,
+    those with numeric keys and integer values are moved into a SortedRun of
+    doubles and 64-bit integers, 16 bytes per entry instead of over 100 in a dict.
+    Runs of equal size are merged, so there are at most log2(n) runs to search.
+    Runs that do not fit in the MemoryBudget are moved to temporary files.
+    It supports the dict operations that Tvar and mapinputs use."""
+    
+    frontlimit = 1000000
+    
+    def __init__(self, budget=None):
+        self.front = {}
+        self.runs = []   # oldest and largest first
+        self.budget = budget or MemoryBudget()
+        
+    def __len__(self):
+        return len(self.front) + sum(len(run) for run in self.runs)
+    
+    def find(self, key):
+        """Return the run and position of key or None.  The front is not searched"""
+        
+        if key is None:
+            return None
+        for run in reversed(self.runs):
+            i = run.index(key)
+            if i >= 0:
+                return run, i
+        return None
+    
+    def __contains__(self, key):
+        return key in self.front or self.find(key) is not None
+    
+    def __getitem__(self, key):
+        try:
+            return self.front[key]
+        except KeyError:
+            found = self.find(key)
+            if found is None:
+                raise
+            return found[0].values[found[1]]
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+        
+    def getmany(self, keys):
+        """Return the values for a list of keys that are all in the table"""
+        
+        if not self.runs:
+            return list(map(self.front.__getitem__, keys))
+        return list(map(self.__getitem__, keys))
+    
+    def __setitem__(self, key, value):
+        if not key in self.front and type(value) is int:
+            found = self.find(key)
+            if found is not None:
+                found[0].values[found[1]] = value
+                return
+        self.front[key] = value
+        if len(self.front) >= self.frontlimit:
+            self.compact()
+    
+    def update(self, pairs):
+        """Add or replace many entries at once
+        
+        A key that is already in a run is not looked up.  The new entry goes in
+        the front, which is searched first, and then into a newer run, which
+        takes precedence when runs are merged"""
+        
+        self.front.update(pairs)
+        if len(self.front) >= self.frontlimit:
+            self.compact()
+    
+    def items(self):
+        return chain(iter(self.front.items()), 
+            *[zip(run.keys, run.values) for run in self.runs])
+    
+    def values(self):
+        return chain(iter(self.front.values()), *[run.values for run in self.runs])
+    
+    def sorteditems(self):
+        """Return an iterator over the items in key order, except a sysmis key"""
+        
+        front = sorted((k, v) for k, v in self.front.items() if k is not None)
+        return heapq.merge(front, *[zip(run.keys, run.values) for run in self.runs],
+            key=itemgetter(0))
+    
+    def valueset(self):
+        """Return a set-like object of the values currently in the table"""
+        
+        return ValueSet(self.values())
+    
+    def compact(self):
+        """Move the numeric entries of the front into a new run and merge runs"""
+        
+        movable = sorted((key, value) for key, value in self.front.items()
+            if key is not None and type(value) is int)
+        for key, value in movable:
+            del self.front[key]
+        self.addrun(SortedRun(array('d', [item[0] for item in movable]),
+            array('q', [item[1] for item in movable])))
+        while len(self.runs) > 1 and len(self.runs[-2]) <= len(self.runs[-1]):
+            newer = self.runs.pop()
+            older = self.runs.pop()
+            self.release(newer)
+            self.release(older)
+            keys, values = array('d'), array('q')
+            # merge is stable, so for a key in both runs the newer entry comes first
+            for key, value in heapq.merge(zip(newer.keys, newer.values), 
+                    zip(older.keys, older.values), key=itemgetter(0)):
+                if keys and keys[-1] == key:
+                    continue
+                keys.append(key)
+                values.append(value)
+            self.addrun(SortedRun(keys, values))
+            
+    def addrun(self, run):
+        nbytes = len(run) * run.itemsize
+        if self.budget.allows(nbytes):
+            self.budget.used += nbytes
+        else:
+            run.spill()
+        self.runs.append(run)
+        
+    def release(self, run):
+        if not run.files:
+            self.budget.used -= len(run) * run.itemsize
+    
+    def setbudget(self, budget):
+        """Charge the runs to budget, e.g., after the table was sent to another
+        process.  Runs arrive in memory, so those that do not fit are moved back to
+        temporary files"""
+        
+        self.budget = budget
+        runs, self.runs = self.runs, []
+        for run in runs:
+            if run.files:
+                self.runs.append(run)
+            else:
+                self.addrun(run)
 
-    def __next__(self):
-        row = next(self.reader)
-        return [str(s, "utf-8") for s in row]
+class MappingDatabase(object):
+    """SQLite file that holds the mapping tables and run state of variables
+    
+    The mappings table has a row for each variable and value with its new value,
+    and the variables table has the type and run state of each variable.  The
+    connection is opened when first needed, so the object can be sent to worker
+    processes, which each open their own.  The file uses write-ahead logging so
+    that workers can read while another writes."""
+    
+    def __init__(self, filespec):
+        if sqlite3 is None:
+            raise ImportError("The sqlite3 module is required for MAPPINGDB")
+        self.filespec = filespec
+        self.conn = None
+        self.connection()
+        
+    def __getstate__(self):
+        return {"filespec": self.filespec, "conn": None}
+    
+    def connection(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.filespec, timeout=600)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS mappings (var TEXT NOT NULL, 
+                key NOT NULL, value, PRIMARY KEY (var, key)) WITHOUT ROWID""")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS variables (var TEXT PRIMARY KEY, 
+                type INTEGER, state TEXT)""")
+            self.conn.commit()
+        return self.conn
+    
+    def getstate(self, name, vtype):
+        """Return the run state saved for variable name or None
+        
+        vtype is the variable type, which must agree with the saved type"""
+        
+        row = self.connection().execute("SELECT type, state FROM variables WHERE var = ?",
+            (name,)).fetchone()
+        if row is None:
+            return None
+        if (row[0] == 0) != (vtype == 0):
+            raise ValueError("The type of variable %s differs from the mapping database" % name)
+        return json.loads(row[1])
+        
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
 
-    def __iter__(self):
-        return self
+class DatabaseTable(object):
+    """Mapping table of one variable kept in a MappingDatabase
+    
+    Only recently used entries are held in memory, in a least recently used cache of
+    at least cachesize entries.  prefetch looks up the distinct values of a block in
+    a few queries before the block is transformed, so the dict operations that Tvar
+    uses are then answered from memory.  New entries are held until commit, which
+    inserts them together with the run state of the variable in one transaction.
+    A sysmis key is stored as sysmiskey, since keys cannot be null."""
+    
+    cachesize = 200000
+    querysize = 500   # keys per lookup query
+    sysmiskey = "$sysmis"
+    
+    def __init__(self, db, name, vtype):
+        self.db = db
+        self.name = name
+        self.vtype = vtype
+        self.cache = OrderedDict()
+        self.new = {}        # entries not yet inserted
+        self.absent = set()  # keys of the last prefetch that are not in the table
+        
+    def __getstate__(self):
+        """The cache is not sent to worker processes.  Entries must be committed first"""
+        
+        state = self.__dict__.copy()
+        state["cache"] = OrderedDict()
+        state["absent"] = set()
+        return state
+        
+    def encode(self, key):
+        return self.sysmiskey if key is None and self.vtype == 0 else key
+    
+    def decode(self, key):
+        return None if key == self.sysmiskey and self.vtype == 0 else key
+    
+    def fetch(self, keys):
+        """Return a dict of the stored entries for keys, which are not in the cache"""
+        
+        conn = self.db.connection()
+        found = {}
+        for start in range(0, len(keys), self.querysize):
+            chunk = [self.encode(key) for key in keys[start:start + self.querysize]]
+            found.update((self.decode(key), value) for key, value in conn.execute(
+                "SELECT key, value FROM mappings WHERE var = ? AND key IN (%s)" 
+                % ",".join("?" * len(chunk)), [self.name] + chunk))
+        return found
+    
+    def prefetch(self, values):
+        """Bring the entries for the distinct values of a block into the cache
+        
+        Entries beyond the cache size are dropped, oldest first, but not those of
+        the block"""
+        
+        cache = self.cache
+        keys = list(dict.fromkeys(values))
+        missing = []
+        for key in keys:
+            if key in cache:
+                cache.move_to_end(key)
+            elif not key in self.new:
+                missing.append(key)
+        found = self.fetch(missing)
+        cache.update(found)
+        self.absent = set(key for key in missing if not key in found)
+        limit = max(self.cachesize, len(keys))
+        while len(cache) > limit:
+            cache.popitem(last=False)
+    
+    def __contains__(self, key):
+        if key in self.cache or key in self.new:
+            return True
+        if key in self.absent:
+            return False
+        found = self.fetch([key])
+        self.cache.update(found)
+        return key in found
+    
+    def __getitem__(self, key):
+        try:
+            return self.cache[key]
+        except KeyError:
+            if key in self.new:
+                return self.new[key]
+            found = self.fetch([key])
+            self.cache.update(found)
+            return found[key]
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+        
+    def getmany(self, keys):
+        """Return the values for a list of keys that are all in the table
+        
+        Keys not in memory are looked up without adding them to the cache"""
+        
+        cache, new = self.cache, self.new
+        missing = [key for key in dict.fromkeys(keys) if not key in cache and not key in new]
+        found = self.fetch(missing)
+        return [cache[key] if key in cache else new[key] if key in new else found[key] 
+            for key in keys]
+    
+    def __setitem__(self, key, value):
+        self.update([(key, value)])
+        
+    def update(self, pairs):
+        """Add or replace many entries.  They are stored by commit"""
+        
+        pairs = dict(pairs)
+        self.new.update(pairs)
+        self.cache.update(pairs)
+        self.absent.difference_update(pairs)
+        if len(self.new) >= mappingchunk:
+            self.insert()
+    
+    def insert(self):
+        """Insert the new entries in the current transaction"""
+        
+        if self.new:
+            self.db.connection().executemany(
+                "INSERT OR REPLACE INTO mappings (var, key, value) VALUES (?, ?, ?)",
+                [(self.name, self.encode(key), value) for key, value in self.new.items()])
+            self.new = {}
+        
+    def commit(self, state):
+        """Store the new entries and state, the run state of the variable"""
+        
+        conn = self.db.connection()
+        self.insert()
+        conn.execute("INSERT OR REPLACE INTO variables (var, type, state) VALUES (?, ?, ?)",
+            (self.name, self.vtype, json.dumps(state)))
+        conn.commit()
+        
+    def __len__(self):
+        self.insert()
+        return self.db.connection().execute("SELECT COUNT(*) FROM mappings WHERE var = ?",
+            (self.name,)).fetchone()[0]
+    
+    def items(self):
+        """Return an iterator over all the entries in key order"""
+        
+        self.insert()
+        return ((self.decode(key), value) for key, value in self.db.connection().execute(
+            "SELECT key, value FROM mappings WHERE var = ? ORDER BY key", (self.name,)))
+    
+    def keys(self):
+        return (key for key, value in self.items())
+    
+    def values(self):
+        return (value for key, value in self.items())
 
+class ValueSet(object):
+    """Sorted array of integer values for membership tests
+    
+    values that are not integers, e.g., None, are kept in a small set"""
+    
+    def __init__(self, values):
+        self.others = set()
+        ints = array('q')
+        for value in values:
+            if type(value) is int:
+                ints.append(value)
+            else:
+                self.others.add(value)
+        if numpy is not None:
+            self.ints = numpy.sort(numpy.frombuffer(ints, dtype=numpy.int64))
+        else:
+            self.ints = array('q', sorted(ints))
+            
+    def __contains__(self, value):
+        if type(value) is not int:
+            return value in self.others
+        ints = self.ints
+        i = bisect_left(ints, value)
+        return i < len(ints) and ints[i] == value
+    
+    def __len__(self):
+        return len(self.ints) + len(self.others)
 
+class Permutation(object):
+    """A keyed pseudo-random permutation of the integers 0 to size-1
+    
+    This is a small balanced Feistel network over the smallest even number of
+    bits that covers size.  Values that fall outside the range are encrypted
+    again (cycle walking), which takes fewer than four steps on average.
+    Indexing with 0, 1, 2, ... therefore yields distinct values in random order
+    at a constant expected cost per value and without remembering earlier values."""
+    
+    rounds = 4
     
+    def __init__(self, size, key):
+        """size is the number of values to permute, and key is an integer
+        that determines the permutation"""
+        
+        self.size = size
+        bits = max((size - 1).bit_length(), 2)
+        self.halfbits = (bits + 1) // 2
+        self.mask = (1 << self.halfbits) - 1
+        rng = random.Random(key)
+        self.keys = [rng.getrandbits(64) for i in range(self.rounds)]
+        self.walks = 0   # extra encryptions to get back into range
+        
+    def __getitem__(self, i):
+        """Return the value at position i of the permutation"""
+        
+        if not 0 <= i < self.size:
+            raise IndexError("permutation index out of range")
+        i = self.encrypt(i)
+        while i >= self.size:
+            self.walks += 1
+            i = self.encrypt(i)
+        return i
+    
+    def encrypt(self, x):
+        halfbits, mask = self.halfbits, self.mask
+        left, right = x >> halfbits, x & mask
+        for key in self.keys:
+            # 64-bit multiply-xorshift mix of the right half with the round key
+            f = ((right ^ key) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+            f ^= f >> 29
+            f = (f * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+            f ^= f >> 32
+            left, right = right, left ^ (f & mask)
+        return (left << halfbits) | right
+
 def Run(args):
     """Execute the SPSSINC ANON extension command"""
 
@@ -492,22 +2480,39 @@ def Run(args):
         Template("SVALUEROOT", subc="OPTIONS", ktype="literal", var="svalueroot"),
         Template("NAMEROOT", subc="OPTIONS", ktype="varname", var="nameroot"),
         Template("METHOD", subc="OPTIONS", ktype="str", var="method", 
-            vallist=['random', 'sequential', 'transform']),
+            vallist=['random', 'sequential', 'transform', 'hash']),
         Template("SEED", subc="OPTIONS", ktype="float", var="seed"),
+        Template("KEY", subc="OPTIONS", ktype="literal", var="key"),
         Template("OFFSET", subc="OPTIONS", ktype="float", var="offset"),
         Template("SCALE", subc="OPTIONS", ktype="float", var="scale"),
         Template("MAXRVALUE", subc="OPTIONS", ktype="int", var="maxrvalue", islist=True),
         Template("ONETOONE", subc="OPTIONS", ktype="existingvarlist", var="onetoone", islist=True),
         Template("MAPPING", subc="OPTIONS", ktype="literal", var="mapping"),
+        Template("BLOCKSIZE", subc="OPTIONS", ktype="int", var="blocksize"),
+        Template("MEMORYLIMIT", subc="OPTIONS", ktype="float", var="memorylimit"),
+        Template("WORKERS", subc="OPTIONS", ktype="int", var="workers"),
+        Template("INCREMENTAL", subc="OPTIONS", ktype="literal", var="incremental"),
+        Template("PROFILE", subc="OPTIONS", ktype="bool", var="profile"),
+        Template("CHECKPOINT", subc="OPTIONS", ktype="literal", var="checkpoint"),
+        Template("RESUME", subc="OPTIONS", ktype="bool", var="resume"),
+        Template("MAPPINGDB", subc="OPTIONS", ktype="literal", var="mappingdb"),
         Template("NAMEMAPPING", subc="SAVE", ktype="literal", var="namemapping"),
         Template("VALUEMAPPING", subc="SAVE", ktype="literal", var="valuemapping"),
+        Template("BINARYMAPPING", subc="SAVE", ktype="literal", var="binarymapping"),
         Template("IGNORETHIS", subc="SAVE", ktype="bool", var="ignorethis"),
+        Template("FILES", subc="BATCH", ktype="literal", var="files", islist=True),
+        Template("OUTDIR", subc="BATCH", ktype="literal", var="outdir"),
+        Template("STREAM", subc="BATCH", ktype="bool", var="stream"),
+        Template("DATASETS", subc="BATCH", ktype="literal", var="datasets", islist=True),
         Template("HELP", subc="", ktype="bool")])
     
     # A HELP subcommand overrides all else
     if "HELP" in args:
         #print helptext
         helper()
+    elif "BATCH" in args:
+        # the variables are in the batch datasets, not necessarily the active one
+        processcmd(oobj, args, anonbatch)
     else:
         processcmd(oobj, args, anon, vardict=spssaux.VariableDict())
         
@@ -0,0 +1,827 @@
+"""Regression tests for SPSSINC ANON
+
+The command is run against the in-memory stand-in for the spss module in
+benchmarks/fakespss.py, so no Statistics installation is needed.
+
+    python -m pytest tests
+    python -m unittest discover tests
+"""
+
+import sys, os, io, json, pickle, random, shutil, tempfile, unittest, contextlib
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+sys.path[:0] = [os.path.join(root, "benchmarks"), os.path.join(root, "src")]
+
+import fakespss
+fakespss.install()
+import SPSSINC_ANON as anon
+
+def numbers(rows, cardinality, seed=1):
+    """Return rows values drawn from cardinality distinct numbers, with some sysmis"""
+
+    r = random.Random(seed)
+    return [None if r.random() < 0.02 else float(r.randrange(cardinality) * 3 + 100)
+        for i in range(rows)]
+
+def strings(rows, cardinality, seed=2, width=12):
+    r = random.Random(seed)
+    return ["K%05d" % r.randrange(cardinality) for i in range(rows)]
+
+def baselinesequential(values, vtype=0, svalueroot=""):
+    """The values of the original cell-by-cell SEQUENTIAL method"""
+
+    if vtype and len(svalueroot) >= vtype:
+        svalueroot = ""
+    table = {}
+    for value in values:
+        if not value in table:
+            seq = len(table)
+            if vtype == 0:
+                table[value] = seq
+            else:
+                table[value] = (svalueroot + str(seq))[-vtype:]
+    return [table[value] for value in values]
+
+def quietly(func, *args, **kwds):
+    """Call func without the messages that the command prints"""
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        return func(*args, **kwds)
+
+class SavStub(object):
+    """In-memory stand-in for the parts of savReaderWriter used by SavDataset
+
+    files maps a file name to its dictionary, an object with the attributes of
+    SavHeaderReader.all(), and its records"""
+
+    files = {}
+
+    class Header(object):
+        def __init__(self, names, types, **kwds):
+            self.varNames, self.varTypes = list(names), dict(types)
+            for name in ["valueLabels", "varLabels", "formats", "missingValues",
+                    "measureLevels", "columnWidths", "alignments", "varAttributes"]:
+                setattr(self, name, kwds.get(name) or {})
+            self.fileLabel = kwds.get("fileLabel")
+            self.caseWeightVar = kwds.get("caseWeightVar")
+
+    class SavHeaderReader(object):
+        def __init__(self, filespec, ioUtf8=False):
+            self.header = SavStub.files[filespec][0]
+        def all(self):
+            return self.header
+        def close(self):
+            pass
+
+    class SavReader(object):
+        def __init__(self, filespec, ioUtf8=False):
+            self.records = SavStub.files[filespec][1]
+            self.shape = type("Shape", (), {"nrows": len(self.records)})
+        def __iter__(self):
+            return (list(record) for record in self.records)
+        def close(self):
+            pass
+
+    class SavWriter(object):
+        def __init__(self, filespec, names, types, ioUtf8=False, **kwds):
+            self.records = []
+            SavStub.files[filespec] = (SavStub.Header(names, types, **kwds), self.records)
+        def writerows(self, records):
+            self.records.extend(list(record) for record in records)
+        def close(self):
+            pass
+
+class AnonTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def newdataset(self, rows=3000):
+        """Make the active dataset with numeric x and y and string s"""
+
+        self.columns = {"x": numbers(rows, 400), "y": numbers(rows, 50, seed=3),
+            "s": strings(rows, 700)}
+        fakespss.newdataset([("x", 0), ("y", 0), ("s", 12)],
+            [self.columns["x"], self.columns["y"], self.columns["s"]])
+
+    def results(self):
+        return dict((name, list(fakespss.column(name))) for name in ["x", "y", "s"])
+
+class TestMethods(AnonTestCase):
+    def testsequential(self):
+        self.newdataset()
+        quietly(anon.anon, ["x", "y", "s"], svalueroot="ID", blocksize=700)
+        self.assertEqual(fakespss.column("x"), baselinesequential(self.columns["x"]))
+        self.assertEqual(fakespss.column("y"), baselinesequential(self.columns["y"]))
+        self.assertEqual(fakespss.column("s"),
+            baselinesequential(self.columns["s"], 12, "ID"))
+
+    def testsequentialnarrow(self):
+        """Sequence numbers that no longer fit keep their last digits, as before"""
+
+        fakespss.newdataset([("s", 2)], [["%02d" % (i % 150) for i in range(300)]])
+        quietly(anon.anon, ["s"], blocksize=64)
+        self.assertEqual(fakespss.column("s"),
+            baselinesequential(["%02d" % (i % 150) for i in range(300)], 2))
+
+    def testtransform(self):
+        self.newdataset()
+        quietly(anon.anon, ["x", "s"], method="transform", offset=5., scale=2.5, blocksize=999)
+        self.assertEqual(fakespss.column("x"),
+            [None if value is None else value * 2.5 + 5. for value in self.columns["x"]])
+        # strings use SEQUENTIAL instead
+        self.assertEqual(fakespss.column("s"), baselinesequential(self.columns["s"], 12))
+
+    def testrandomrepeatable(self):
+        """Block size, variable order, and WORKERS do not change the values"""
+
+        self.newdataset()
+        quietly(anon.anon, ["x", "y", "s"], method="random", seed=7, maxrvalue=[99999])
+        expected = self.results()
+        self.newdataset()
+        quietly(anon.anon, ["s", "y", "x"], method="random", seed=7, maxrvalue=[99999],
+            blocksize=333)
+        self.assertEqual(self.results(), expected)
+        self.newdataset()
+        quietly(anon.anon, ["x", "y", "s"], method="random", seed=7, maxrvalue=[99999],
+            workers=2)
+        self.assertEqual(self.results(), expected)
+
+    def testcellbycell(self):
+        """trf gives the values of trfblock and records the new values the same way"""
+
+        self.newdataset()
+        with anon.DataStep():
+            ds = fakespss.Dataset()
+            for vnum, name in [(0, "x"), (2, "s")]:
+                for method, onetoone in [("sequential", False), ("random", False),
+                        ("random", True), ("transform", False)]:
+                    pair = [quietly(anon.Tvar, ds.varlist[vnum], "ID", method, 3, 2, 99999,
+                        onetoone, seed=7) for i in range(2)]
+                    for t in pair:
+                        t.newkeys = []
+                    values = self.columns[name][:500]
+                    self.assertEqual([pair[0].trf(value) for value in values],
+                        pair[1].trfblock(values))
+                    self.assertEqual(pair[0].newcount, pair[1].newcount)
+                    self.assertEqual(pair[0].newkeys, pair[1].newkeys)
+
+    def testonetoone(self):
+        self.newdataset()
+        quietly(anon.anon, ["x", "s"], method="random", seed=7, maxrvalue=[450, 999],
+            onetoone=["x", "s"])
+        for name in ["x", "s"]:
+            pairs = set(zip(self.columns[name], fakespss.column(name)))
+            self.assertEqual(len(set(new for old, new in pairs)), len(pairs))
+
+    def testhash(self):
+        self.newdataset()
+        quietly(anon.anon, ["x", "s"], method="hash", key="secret")
+        expected = self.results()
+        self.newdataset()
+        quietly(anon.anon, ["s", "x"], method="hash", key="secret", blocksize=100)
+        self.assertEqual(self.results(), expected)
+        self.newdataset()
+        quietly(anon.anon, ["x", "s"], method="hash", key="other")
+        self.assertNotEqual(self.results()["x"], expected["x"])
+        # SEED is not used as the key
+        self.newdataset()
+        with self.assertRaises(ValueError):
+            quietly(anon.anon, ["x"], method="hash", seed=7)
+
+    def testhashcollision(self):
+        self.newdataset()
+        with self.assertRaises(ValueError):
+            quietly(anon.anon, ["x"], method="hash", key="secret", maxrvalue=[50],
+                onetoone=["x"])
+
+class TestPermutation(unittest.TestCase):
+    def testbijective(self):
+        """Every value of the range comes up exactly once, including ranges that need
+        cycle walking and the smallest ranges"""
+
+        for size in [1, 2, 3, 5, 16, 17, 1000, 4099]:
+            for key in [1, 12345]:
+                p = anon.Permutation(size, key)
+                self.assertEqual(sorted(p[i] for i in range(size)), list(range(size)))
+
+    def testkeyed(self):
+        first = [anon.Permutation(1000, 1)[i] for i in range(20)]
+        self.assertEqual(first, [anon.Permutation(1000, 1)[i] for i in range(20)])
+        self.assertNotEqual(first, [anon.Permutation(1000, 2)[i] for i in range(20)])
+        with self.assertRaises(IndexError):
+            anon.Permutation(1000, 1)[1000]
+
+class TestCompactTable(AnonTestCase):
+    """The front limit is lowered so that small tables are compacted"""
+
+    def setUp(self):
+        AnonTestCase.setUp(self)
+        self.frontlimit = anon.CompactTable.frontlimit
+        anon.CompactTable.frontlimit = 100
+
+    def tearDown(self):
+        anon.CompactTable.frontlimit = self.frontlimit
+        AnonTestCase.tearDown(self)
+
+    def filled(self, budget=None):
+        r = random.Random(3)
+        keys = [float(k) for k in r.sample(range(100000), 1000)]
+        expected = dict(zip(keys, range(1000)))
+        table = anon.CompactTable(budget)
+        for start in range(0, 1000, 30):
+            table.update(list(expected.items())[start:start + 30])
+        table[None] = 5000
+        expected[None] = 5000
+        return table, expected
+
+    def testcompaction(self):
+        table, expected = self.filled()
+        self.assertTrue(table.runs and len(table.front) < 100)
+        # runs are merged as they reach the same size, so there are few to search
+        self.assertTrue(len(table.runs) <= 10)
+        self.assertEqual(len(table), len(expected))
+        self.assertEqual(dict(table.items()), expected)
+        self.assertEqual(table.getmany(list(expected)), list(expected.values()))
+        self.assertFalse(-1. in table)
+        keys = [key for key, value in table.sorteditems()]
+        self.assertEqual(keys, sorted(key for key in expected if key is not None))
+        # replacing an entry that is in a run
+        key = keys[0]
+        table[key] = -7
+        self.assertEqual(table[key], -7)
+        self.assertEqual(len(table), len(expected))
+
+    def testspill(self):
+        """Runs beyond the budget are moved to files and still found"""
+
+        budget = anon.MemoryBudget(0.01)
+        table, expected = self.filled(budget)
+        self.assertTrue(any(run.files for run in table.runs))
+        self.assertTrue(budget.used <= budget.limit)
+        self.assertEqual(dict(table.items()), expected)
+        valueset = table.valueset()
+        self.assertTrue(all(value in valueset for value in expected.values()))
+
+    def testmemorylimit(self):
+        """MEMORYLIMIT does not change the results"""
+
+        self.newdataset()
+        quietly(anon.anon, ["x", "y", "s"], method="random", seed=7, maxrvalue=[99999],
+            onetoone=["x"])
+        expected = self.results()
+        self.newdataset()
+        quietly(anon.anon, ["x", "y", "s"], method="random", seed=7, maxrvalue=[99999],
+            onetoone=["x"], memorylimit=0.001)
+        self.assertEqual(self.results(), expected)
+        self.newdataset()
+        quietly(anon.anon, ["x", "y", "s"], method="random", seed=7, maxrvalue=[99999],
+            onetoone=["x"], memorylimit=0.001, workers=2)
+        self.assertEqual(self.results(), expected)
+
+    def testsetbudget(self):
+        """A table sent to a worker is charged to the worker's share of the budget"""
+
+        budget = anon.MemoryBudget(0.04)
+        share = budget.share(4)
+        self.assertEqual(share.limit, budget.limit // 4)
+        table, expected = self.filled(budget)
+        self.assertFalse(any(run.files for run in table.runs))
+        copy = pickle.loads(pickle.dumps(table))
+        copy.setbudget(share)
+        self.assertTrue(any(run.files for run in copy.runs))
+        self.assertTrue(share.used <= share.limit)
+        self.assertEqual(dict(copy.items()), expected)
+
+class TestMappings(AnonTestCase):
+    def roundtrip(self, binary):
+        """A later run with MAPPING maps the values of the first run the same way"""
+
+        kind = binary and "binarymapping" or "valuemapping"
+        spec = self.path("mapping" + (binary and ".bin" or ".csv"))
+        self.newdataset()
+        quietly(anon.anon, ["x", "y", "s"], method="random", seed=7, maxrvalue=[99999],
+            onetoone=["x"], **{kind: spec})
+        first = self.results()
+        old = dict((name, dict(zip(self.columns[name], first[name]))) for name in first)
+        self.newdataset(rows=5000)
+        quietly(anon.anon, ["x", "y", "s"], method="random", seed=8, maxrvalue=[99999],
+            onetoone=["x"], mapping=spec)
+        for name, values in self.results().items():
+            for value, newvalue in zip(self.columns[name], values):
+                if value in old[name]:
+                    self.assertEqual(newvalue, old[name][value])
+        pairs = set(zip(self.columns["x"], fakespss.column("x")))
+        self.assertEqual(len(set(new for old, new in pairs)), len(pairs))
+
+    def testcsvroundtrip(self):
+        self.roundtrip(False)
+
+    def testbinaryroundtrip(self):
+        self.roundtrip(True)
+
+    def testsequentialmapping(self):
+        """SEQUENTIAL continues numbering after the mapped values"""
+
+        spec = self.path("mapping.csv")
+        fakespss.newdataset([("x", 0)], [[3., 1., 3., 2.]])
+        quietly(anon.anon, ["x"], valuemapping=spec)
+        fakespss.newdataset([("x", 0)], [[2., 5., 1., 4.]])
+        quietly(anon.anon, ["x"], mapping=spec)
+        self.assertEqual(fakespss.column("x"), [2, 3, 1, 4])
+
+class TestRuns(AnonTestCase):
+    options = dict(method="random", seed=7, maxrvalue=[99999], onetoone=["x", "s"],
+        blocksize=400)
+
+    def failedrun(self, spec, failat, **kwds):
+        """Run with checkpoint spec and make write number failat to the dataset fail"""
+
+        setitem = fakespss.CaseList.__setitem__
+        writes = []
+        def failing(cases, key, value):
+            writes.append(key)
+            if len(writes) == failat:
+                raise fakespss.SpssError("injected write failure")
+            setitem(cases, key, value)
+        fakespss.CaseList.__setitem__ = failing
+        try:
+            with self.assertRaises(fakespss.SpssError):
+                quietly(anon.anon, ["x", "y", "s"], checkpoint=spec, **dict(self.options, **kwds))
+        finally:
+            fakespss.CaseList.__setitem__ = setitem
+
+    def testresume(self):
+        """A run that fails while writing cases is finished by RESUME"""
+
+        self.newdataset()
+        quietly(anon.anon, ["x", "y", "s"], **self.options)
+        expected = self.results()
+
+        self.newdataset()
+        spec = self.path("anon.checkpoint")
+        self.failedrun(spec, 10)
+        self.assertNotEqual(self.results(), expected)
+        quietly(anon.anon, ["x", "y", "s"], checkpoint=spec, resume=True, **self.options)
+        self.assertEqual(self.results(), expected)
+        self.assertFalse(os.path.exists(spec))
+
+    def testresumeworkers(self):
+        """RESUME also finishes a run with WORKERS that failed in the middle of a block"""
+
+        self.newdataset()
+        quietly(anon.anon, ["x", "y", "s"], **self.options)
+        expected = self.results()
+
+        self.newdataset()
+        spec = self.path("anon.checkpoint")
+        self.failedrun(spec, 8, workers=2)
+        quietly(anon.anon, ["x", "y", "s"], checkpoint=spec, resume=True, **self.options)
+        self.assertEqual(self.results(), expected)
+
+    def testresumeotherdata(self):
+        """RESUME refuses a dataset without the values the checkpoint recorded"""
+
+        self.newdataset()
+        spec = self.path("anon.checkpoint")
+        self.failedrun(spec, 10)
+        self.newdataset()
+        with self.assertRaises(ValueError):
+            quietly(anon.anon, ["x", "y", "s"], checkpoint=spec, resume=True, **self.options)
+        with self.assertRaises(ValueError):
+            quietly(anon.anon, ["x"], resume=True, **self.options)
+
+    def testincremental(self):
+        """Anonymizing appended cases continues the mappings of the full run"""
+
+        self.newdataset()
+        quietly(anon.anon, ["x", "y", "s"], **self.options)
+        expected = self.results()
+
+        spec = self.path("anon.state")
+        rows = 1700
+        self.newdataset()
+        full = self.columns
+        fakespss.newdataset([("x", 0), ("y", 0), ("s", 12)],
+            [full[name][:rows] for name in ["x", "y", "s"]])
+        quietly(anon.anon, ["x", "y", "s"], incremental=spec, **self.options)
+        done = self.results()
+        fakespss.newdataset([("x", 0), ("y", 0), ("s", 12)],
+            [done[name] + full[name][rows:] for name in ["x", "y", "s"]])
+        quietly(anon.anon, ["x", "y", "s"], incremental=spec, **self.options)
+        self.assertEqual(self.results(), expected)
+
+    def testincrementalnameroot(self):
+        """NAMEROOT is rejected with INCREMENTAL before anything is changed"""
+
+        self.newdataset()
+        spec = self.path("anon.state")
+        with self.assertRaises(ValueError):
+            quietly(anon.anon, ["x", "y", "s"], nameroot="v", incremental=spec, **self.options)
+        self.assertEqual(self.results(), self.columns)
+        self.assertFalse(os.path.exists(spec))
+
+    def testmappingdb(self):
+        """Runs that share MAPPINGDB give the same values as INCREMENTAL"""
+
+        spec = self.path("anon.state")
+        dbspec = self.path("anon.db")
+        rows = 1700
+        self.newdataset()
+        full = self.columns
+        parts = [dict((name, full[name][:rows]) for name in full),
+            dict((name, full[name][rows:]) for name in full)]
+
+        results = {}
+        for part in parts:
+            fakespss.newdataset([("x", 0), ("y", 0), ("s", 12)],
+                [part[name] for name in ["x", "y", "s"]])
+            quietly(anon.anon, ["x", "y", "s"], mappingdb=dbspec, **self.options)
+            for name, values in self.results().items():
+                results.setdefault(name, []).extend(values)
+
+        fakespss.newdataset([("x", 0), ("y", 0), ("s", 12)],
+            [parts[0][name] for name in ["x", "y", "s"]])
+        quietly(anon.anon, ["x", "y", "s"], incremental=spec, **self.options)
+        done = self.results()
+        fakespss.newdataset([("x", 0), ("y", 0), ("s", 12)],
+            [done[name] + parts[1][name] for name in ["x", "y", "s"]])
+        quietly(anon.anon, ["x", "y", "s"], incremental=spec, **self.options)
+        self.assertEqual(results, self.results())
+
+    def testmappingdballocator(self):
+        """A variable restored from MAPPINGDB keeps its allocator when the range
+        fills past rejectionfill, as with INCREMENTAL"""
+
+        spec = self.path("anon.state")
+        dbspec = self.path("anon.db")
+        options = dict(method="random", seed=7, maxrvalue=[999], onetoone=["s"])
+        parts = [["%03d" % i for i in range(300)],
+            ["%03d" % i for i in range(300, 600)]]
+
+        results = []
+        for part in parts:
+            fakespss.newdataset([("s", 3)], [part])
+            quietly(anon.anon, ["s"], mappingdb=dbspec, **options)
+            results.extend(fakespss.column("s"))
+
+        fakespss.newdataset([("s", 3)], [parts[0]])
+        quietly(anon.anon, ["s"], incremental=spec, **options)
+        done = list(fakespss.column("s"))
+        fakespss.newdataset([("s", 3)], [done + parts[1]])
+        quietly(anon.anon, ["s"], incremental=spec, **options)
+        self.assertEqual(results, list(fakespss.column("s")))
+        self.assertEqual(len(set(results)), 600)
+
+class TestProfile(AnonTestCase):
+    def testprofile(self):
+        """PROFILE displays the phases and variable counts and writes them as json"""
+
+        self.newdataset()
+        spec = self.path("values.csv")
+        quietly(anon.anon, ["x", "s"], method="random", seed=7, maxrvalue=[99999],
+            onetoone=["x"], valuemapping=spec, profile=True)
+        phases, variables = fakespss.state["tables"]
+        self.assertEqual(phases["collabels"], ["Seconds", "Percent"])
+        for phase in ["read cases", "transform values", "write cases", "write mappings"]:
+            self.assertTrue(phase in phases["rowlabels"])
+        self.assertEqual(variables["rowlabels"], ["x", "s"])
+        stats = dict(zip(variables["collabels"], variables["rows"][0]))
+        self.assertEqual(stats["New Values"], len(set(self.columns["x"])))
+        self.assertEqual(stats["Table Size"], stats["New Values"])
+        self.assertEqual(dict(zip(variables["collabels"], variables["rows"][1]))["Collisions"],
+            "-")
+        with open(spec + ".profile.json", encoding="utf-8") as f:
+            report = json.load(f)
+        self.assertEqual(report["cases"], 3000)
+        self.assertEqual([name for name, stats in report["variables"]], ["x", "s"])
+
+    def testnoprofile(self):
+        self.newdataset()
+        spec = self.path("values.csv")
+        quietly(anon.anon, ["x"], valuemapping=spec)
+        self.assertEqual(fakespss.state["tables"], [])
+        self.assertFalse(os.path.exists(spec + ".profile.json"))
+
+class TestBatch(AnonTestCase):
+    variables = [("x", 0), ("y", 0), ("s", 12)]
+    options = dict(method="random", seed=7, maxrvalue=[99999], onetoone=["x", "s"])
+
+    def parts(self):
+        """Return the columns of the dataset split into three parts"""
+
+        self.newdataset()
+        return [[self.columns[name][start:start + 1000] for name in ["x", "y", "s"]]
+            for start in [0, 1000, 2000]]
+
+    def expected(self):
+        """The values of one run over all the cases"""
+
+        self.newdataset()
+        quietly(anon.anon, ["x", "y", "s"], **self.options)
+        return [[values[start:start + 1000] for values in self.results().values()]
+            for start in [0, 1000, 2000]]
+
+    def testfiles(self):
+        """A value in more than one file gets the same new value in all of them"""
+
+        parts = self.parts()
+        expected = self.expected()
+        fakespss.newdataset(self.variables, parts[0])
+        files = [self.path("in%s.sav" % i) for i in range(3)]
+        for filespec, columns in zip(files, parts):
+            fakespss.newfile(filespec, self.variables, columns)
+        outdir = self.path("out")
+        spec = self.path("values.csv")
+        quietly(anon.anonbatch, ["x", "y", "s"], files=files, outdir=outdir,
+            valuemapping=spec, **self.options)
+        for filespec, columns in zip(files, expected):
+            outfile = os.path.join(outdir, os.path.basename(filespec))
+            self.assertEqual([fakespss.filecolumn(outfile, name) for name in ["x", "y", "s"]],
+                columns)
+        # the input files are not changed
+        self.assertEqual([fakespss.filecolumn(files[0], name) for name in ["x", "y", "s"]],
+            parts[0])
+        # the active dataset was given a name and is active again
+        self.assertEqual(fakespss.ActiveDataset(), "anonbatchactive")
+        self.assertEqual(fakespss.column("x"), parts[0][0])
+        with open(spec, encoding="utf-8") as f:
+            headers = [line.strip() for line in f if not "=" in line]
+        self.assertEqual(headers, ["x", "y", "s"])
+
+    def testdatasets(self):
+        parts = self.parts()
+        expected = self.expected()
+        for i, columns in enumerate(parts):
+            data = fakespss.ActiveData(self.variables, columns)
+            data.name = "d%s" % i
+            fakespss.state["datasets"][data.name] = data
+        quietly(anon.anonbatch, ["x", "y", "s"], datasets=["d0", "d1", "d2"], **self.options)
+        for i, columns in enumerate(expected):
+            data = fakespss.state["datasets"]["d%s" % i]
+            self.assertEqual(data.columns, columns)
+
+    def testmappingreadonce(self):
+        """MAPPING is read for the first dataset only"""
+
+        spec = self.path("values.csv")
+        self.newdataset()
+        quietly(anon.anon, ["x", "s"], valuemapping=spec, **self.options)
+        parts = self.parts()
+        for i, columns in enumerate(parts):
+            data = fakespss.ActiveData(self.variables, columns)
+            data.name = "d%s" % i
+            fakespss.state["datasets"][data.name] = data
+        loadmappingrows = anon.loadmappingrows
+        loads = []
+        def counting(t, rows):
+            loads.append(t.vname)
+            loadmappingrows(t, rows)
+        anon.loadmappingrows = counting
+        try:
+            quietly(anon.anonbatch, ["x", "s"], datasets=["d0", "d1", "d2"], mapping=spec,
+                **self.options)
+        finally:
+            anon.loadmappingrows = loadmappingrows
+        self.assertEqual(sorted(set(loads)), ["s", "x"])
+        self.assertEqual(len(loads), 2)
+
+    def testerrors(self):
+        self.newdataset()
+        with self.assertRaises(ValueError):
+            anon.anonbatch(["x"], files=[self.path("a.sav")])
+        with self.assertRaises(ValueError):
+            anon.anonbatch(["x"], datasets=["d0"], incremental=self.path("state"))
+        with self.assertRaises(ValueError):
+            anon.anonbatch(["x"])
+
+class TestSavFile(AnonTestCase):
+    """anonfile and BATCH STREAM=YES with a stand-in for savReaderWriter"""
+
+    def setUp(self):
+        AnonTestCase.setUp(self)
+        self.savreaderwriter = anon.savReaderWriter
+        anon.savReaderWriter = SavStub
+        SavStub.files = {}
+
+    def tearDown(self):
+        anon.savReaderWriter = self.savreaderwriter
+        AnonTestCase.tearDown(self)
+
+    def savfile(self, filespec, start=0, end=3000):
+        self.newdataset()
+        records = list(zip(*[self.columns[name][start:end] for name in ["x", "y", "s"]]))
+        SavStub.files[filespec] = (SavStub.Header(["x", "y", "s"], {"x": 0, "y": 0, "s": 12},
+            valueLabels={"x": {100.: "a"}, "y": {103.: "b"}}, missingValues={"x": {"values": [1]}},
+            varLabels={"x": "label"}), records)
+        return [list(column) for column in zip(*records)]
+
+    def testanonfile(self):
+        """The output file has the values of a run on the active dataset"""
+
+        infile, outfile = self.path("in.sav"), self.path("out.sav")
+        columns = self.savfile(infile)
+        options = dict(method="random", seed=7, maxrvalue=[99999], blocksize=700)
+        quietly(anon.anonfile, infile, outfile, ["x", "s"], nameroot="v", **options)
+        header, records = SavStub.files[outfile]
+        fakespss.newdataset([("x", 0), ("y", 0), ("s", 12)], columns)
+        quietly(anon.anon, ["x", "s"], **options)
+        self.assertEqual([list(column) for column in zip(*records)],
+            [fakespss.column(name) for name in ["x", "y", "s"]])
+        self.assertEqual(header.varNames, ["v1", "y", "v2"])
+        self.assertEqual(header.valueLabels, {"y": {103.: "b"}})
+        self.assertEqual(header.missingValues, {})
+        self.assertEqual(header.varLabels, {"v1": "label"})
+        # the input file is not changed
+        self.assertEqual([list(column) for column in zip(*SavStub.files[infile][1])], columns)
+
+    def testonetoone(self):
+        infile, outfile = self.path("in.sav"), self.path("out.sav")
+        columns = self.savfile(infile)
+        quietly(anon.anonfile, infile, outfile, ["x", "s"], method="random", seed=7,
+            maxrvalue=[450, 999], onetoone=["x", "s"], blocksize=500)
+        newcolumns = [list(column) for column in zip(*SavStub.files[outfile][1])]
+        for old, new in [(columns[0], newcolumns[0]), (columns[2], newcolumns[2])]:
+            pairs = set(zip(old, new))
+            self.assertEqual(len(set(new for old, new in pairs)), len(pairs))
+
+    def testbatchstream(self):
+        """STREAM=YES gives the same files as BATCH FILES and leaves the active dataset"""
+
+        options = dict(method="random", seed=7, maxrvalue=[99999])
+        files = [self.path("in%s.sav" % i) for i in range(3)]
+        parts = [self.savfile(filespec, start, start + 1000)
+            for filespec, start in zip(files, [0, 1000, 2000])]
+        self.newdataset()
+        active = self.columns
+        quietly(anon.anonbatch, ["x", "y", "s"], files=files, outdir=self.path("out"),
+            stream=True, **options)
+        self.assertEqual(self.results(), active)
+        for i, filespec in enumerate(files):
+            fakespss.newfile(filespec, [("x", 0), ("y", 0), ("s", 12)], parts[i])
+        quietly(anon.anonbatch, ["x", "y", "s"], files=files, outdir=self.path("out2"),
+            **options)
+        for filespec in files:
+            name = os.path.basename(filespec)
+            records = SavStub.files[os.path.join(self.path("out"), name)][1]
+            self.assertEqual([list(column) for column in zip(*records)],
+                [fakespss.filecolumn(os.path.join(self.path("out2"), name), varname)
+                    for varname in ["x", "y", "s"]])
+
+    def testerrors(self):
+        infile = self.path("in.sav")
+        self.savfile(infile)
+        with self.assertRaises(ValueError):
+            anon.anonfile(infile, infile, ["x"])
+        with self.assertRaises(ValueError):
+            anon.anonfile(infile, self.path("out.sav"), ["x"], incremental=self.path("state"))
+        anon.savReaderWriter = None
+        with self.assertRaises(ImportError):
+            anon.anonfile(infile, self.path("out.sav"), ["x"])
+
+class TestDataStep(AnonTestCase):
+    def testpending(self):
+        """EXECUTE is submitted only when there are pending transformations"""
+
+        for pending in [False, True]:
+            data = fakespss.newdataset([("x", 0), ("y", 0)], [[3., 1., 3.], [1., 2., 3.]],
+                pending=pending)
+            quietly(anon.anon, ["x"])
+            self.assertEqual(fakespss.column("x"), [0, 1, 0])
+            self.assertEqual(data.stats["executes"], pending and 1 or 0)
+            self.assertEqual(fakespss.state["submitted"].count("EXECUTE"), pending and 1 or 0)
+            self.assertFalse(fakespss.IsDataStepInProgress())
+
+    def testdatastepinprogress(self):
+        """A data step that is already open is an error, and EXECUTE is not tried"""
+
+        data = fakespss.newdataset([("x", 0)], [[1., 2.]])
+        fakespss.StartDataStep()
+        try:
+            with self.assertRaises(fakespss.SpssError):
+                quietly(anon.anon, ["x"])
+        finally:
+            fakespss.EndDataStep()
+        self.assertEqual(data.stats["executes"], 0)
+        self.assertEqual(fakespss.column("x"), [1., 2.])
+
+class TestCapacity(AnonTestCase):
+    def output(self, func, *args, **kwds):
+        """Return what func prints"""
+
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            func(*args, **kwds)
+        return out.getvalue()
+
+    def testestimatenew(self):
+        fakespss.newdataset([("x", 0)], [[float(i % 500) for i in range(5000)]])
+        with anon.DataStep():
+            ds = fakespss.Dataset()
+            t = anon.Tvar(ds.varlist[0], "", "random", None, None, 99999, True)
+            # a sample of all the cases is exact
+            self.assertEqual(anon.estimatenew(ds, 0, t, 0, 5000, blocks=100, blocksize=100),
+                (500, 500, 500))
+            t.table.update((float(i), i) for i in range(100))
+            self.assertEqual(anon.estimatenew(ds, 0, t, 0, 5000)[0], 400)
+            # values in the table are not new, and only cases from firstcase are read
+            self.assertEqual(anon.estimatenew(ds, 0, t, 4200, 4250), (50, 50, 50))
+            observed, low, high = anon.estimatenew(ds, 0, t, 0, 5000, blocks=10, blocksize=50)
+            self.assertTrue(observed <= low <= high <= 5000)
+
+    def testonetoonesample(self):
+        """Many repeats of a few values fit even though the estimate is too high"""
+
+        fakespss.newdataset([("id", 0)], [[float(i % 10100) for i in range(200000)]])
+        printed = self.output(anon.anon, ["id"], method="random", seed=1, maxrvalue=[49999],
+            onetoone=["id"])
+        self.assertTrue("Warning: variable id" in printed)
+        self.assertEqual(len(set(fakespss.column("id"))), 10100)
+
+    def testonetoonetoosmall(self):
+        self.newdataset()
+        before = self.results()
+        with self.assertRaises(ValueError):
+            quietly(anon.anon, ["x"], method="random", seed=7, maxrvalue=[100],
+                onetoone=["x"])
+        # the check is made before any case is changed
+        self.assertEqual(self.results(), before)
+
+    def testsequentialwidth(self):
+        fakespss.newdataset([("s", 2)], [["%03d" % (i % 300) for i in range(3000)]])
+        self.assertTrue("will probably not all fit" in
+            self.output(anon.anon, ["s"], blocksize=500))
+        fakespss.newdataset([("s", 3)], [["%03d" % (i % 300) for i in range(3000)]])
+        self.assertFalse("Warning" in self.output(anon.anon, ["s"]))
+
+    def testnosample(self):
+        """The sample is not read when there is room for a new value for every case"""
+
+        data = fakespss.newdataset([("s", 20), ("x", 0)],
+            [["K%s" % i for i in range(3000)], [float(i) for i in range(3000)]])
+        quietly(anon.anon, ["s", "x"], method="random", maxrvalue=[99999], onetoone=["x"])
+        self.assertEqual(data.stats["valuesread"], 6000)
+        data = fakespss.newdataset([("x", 0)], [[float(i % 1000) for i in range(3000)]])
+        quietly(anon.anon, ["x"], method="random", maxrvalue=[1999], onetoone=["x"])
+        self.assertTrue(data.stats["valuesread"] > 3000)
+
+    def testallocator(self):
+        """Strings expected to use less than half the range are drawn by rejection.
+        Numeric variables always use the permutation"""
+
+        fakespss.newdataset([("s", 4), ("t", 4), ("x", 0)],
+            [["K%s" % i for i in range(3000)], ["K%s" % (i % 600) for i in range(3000)],
+            [float(i % 600) for i in range(3000)]])
+        quietly(anon.anon, ["s", "t", "x"], method="random", seed=1, maxrvalue=[3999, 1499, 1499],
+            onetoone=["s", "t", "x"], profile=True)
+        variables = fakespss.state["tables"][-1]
+        allocators = [dict(zip(variables["collabels"], row))["Allocator"]
+            for row in variables["rows"]]
+        self.assertEqual(allocators, ["permutation", "rejection", "permutation"])
+
+class TestDictionary(unittest.TestCase):
+    def testreplacementnames(self):
+        self.assertEqual(anon.replacementnames(["a", "b"], 2, "v"), ["v1", "v2"])
+        # new names are numbered past any existing name of the form, in any case
+        self.assertEqual(anon.replacementnames(["V7", "v12x", "var3", "v2"], 3, "v"),
+            ["v8", "v9", "v10"])
+        self.assertEqual(anon.replacementnames(["a.b1"], 1, "a.b"), ["a.b2"])
+        with self.assertRaises(ValueError):
+            anon.replacementnames([], 1, "x" * 64)
+
+    def testmetadatasyntax(self):
+        self.assertEqual(anon.metadatasyntax(["a", "b"]),
+            ["VALUE LABELS a b .", "MISSING VALUES a b ()."])
+        self.assertEqual(anon.metadatasyntax(["a", "b"], ["v1", "v2"])[-1],
+            "RENAME VARIABLES ( a b = v1 v2 ).")
+
+    def testmetadatasyntaxwide(self):
+        """Long variable lists are split into lines of about 80 characters"""
+
+        oldnames = ["variable%03d" % i for i in range(200)]
+        lines = anon.metadatasyntax(oldnames, ["v%d" % i for i in range(200)])
+        self.assertTrue(all(len(line) <= 80 for line in lines))
+        self.assertEqual(" ".join(lines).split()[:2], ["VALUE", "LABELS"])
+        self.assertEqual(sum(line.endswith(".") for line in lines), 3)
+
+    def testdictionarychanged(self):
+        fakespss.newdataset([("a", 0), ("b", 8), ("v1", 0)], [[1., 2.], ["x", "y"], [0., 0.]])
+        data = fakespss.state["data"]
+        for v in data.variables:
+            v.valueLabels = {1: "one"}
+            v.missingValues = (1, 9, None, None)
+        quietly(anon.anon, ["a", "b"], nameroot="v")
+        self.assertEqual([v.name for v in data.variables], ["v2", "v3", "v1"])
+        self.assertEqual([v.valueLabels for v in data.variables], [{}, {}, {1: "one"}])
+        self.assertEqual(data.variables[0].missingValues, (0, None, None, None))
+        # one command each for all the variables
+        self.assertEqual(data.stats["dictionarycommands"], 3)
+
+if __name__ == "__main__":
+    unittest.main()